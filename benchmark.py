@@ -0,0 +1,206 @@
+"""
+Benchmarks the title parsing and reply rendering paths against a corpus of real-world and adversarial input.
+
+Reports the throughput and the worst case latency (along with the input that caused it) for each benchmark,
+so changes to TITLE_MATCH or the keyword classifier can be checked for backtracking blowups before deploying.
+No api or reddit requests are made.
+
+Usage: python benchmark.py [--corpus titles.txt] [--repeat 20]
+"""
+
+import argparse
+import random
+import time
+from parser import parse_title_data, render_reply
+from utils import calc_acc, calc_mods
+from config import MODS_INT
+
+# the shapes of titles seen on r/osureport, well formed and otherwise
+TITLES = [
+    "[osu!std] tybug2 | blatant multiaccount",
+    "[osu!taiko]tybug2|spin hacker",
+    "[osu!m] not nathan",
+    "[osu!std] SwordArtOnline_old | cheating",
+    "[osu!std] rttyu-i | Account Sharing/Multi [ Discussion ]",
+    "[osu!std] Player Name | Relax (UR 40, cv)",
+    "[osu!std] xX_Cheater_Xx | aim assist, obvious in replay",
+    "[osu!std and osu!taiko] someone | multi-account",
+    "[std] someone | timewarp on every top play",
+    "[osu!mania] keysmasher | replay editing / stealing",
+    "[o!ctb] fruitninja | auto",
+    "[osu!] someone | blatant relax",
+    "[osu!std] new_account123 | spinhack 477 spm",
+    "[osu!std] some guy | Time-warp (DT plays way too slow)",
+    "[osu!catch] someone else | multi",
+    "[osu!std] player | blatant ur 30 on 300bpm streams",
+    "[osu!std] [ sony ]",
+    "[mania] suki | cheating",
+    "[meta] Changes to the subreddit rules",
+    "Discussion thread for the latest ban wave",
+    "[osu!std] multiple players in this lobby are cheating",
+    "cookiezi | being too good at the game",
+    "[os!c] suki | cheating",
+    "[!std] suki | cheating",
+    "[osu!std] megathread for reports about a tournament",
+    "[osu!std] éèê | 突然强大了",
+]
+
+
+def adversarial_titles():
+    """
+    Returns titles crafted to stress TITLE_MATCH (its repeated "and" group) and the tokenizer.
+    """
+
+    return [
+        # long chains of gamemodes that never close the bracket, forcing the "and" group to give up
+        "[" + " and ".join(["osu!std"] * 2000),
+        "[" + "std and " * 2000 + "x",
+        "[osu!std" + " and osu!s" * 2000 + " and ]",
+        "[o!" * 5000,
+        "[" * 10000,
+        # huge but well formed titles
+        "[osu!std] " + "a" * 20000,
+        "[osu!std] player | " + " | ".join(["multi"] * 5000),
+        "[osu!std] player |" + " " * 20000 + "blatant",
+        "[osu!std] player | " + "/".join(["spin", "relax", "warp"] * 3000),
+        "[osu!std and osu!taiko and osu!mania and osu!catch] " + "x/" * 10000,
+    ]
+
+
+def random_play(mode):
+    """
+    Returns a play (as returned by get_user_best) with random hit counts, for the given mode.
+    """
+
+    play = {
+        key: str(random.randint(0, 2000))
+        for key in [
+            "count50",
+            "count100",
+            "count300",
+            "countmiss",
+            "countkatu",
+            "countgeki",
+        ]
+    }
+    play["count300"] = str(int(play["count300"]) + 1)  # never divide by zero
+    play.update(
+        {
+            "beatmap_id": str(random.randint(1, 4000000)),
+            "enabled_mods": str(random.choice(list(MODS_INT.values()))),
+            "pp": str(random.uniform(0, 1500)),
+            "rank": random.choice(["XH", "X", "SH", "S", "A", "B", "C", "D"]),
+            "date": "2019-06-22 09:11:16",
+        }
+    )
+    return play
+
+
+def random_reply_inputs(count):
+    """
+    Returns count (user_data, plays, previous_links, mode) tuples for render_reply.
+    """
+
+    inputs = []
+    for _ in range(count):
+        mode = str(random.randint(0, 3))
+        user_data = {
+            "username": "player{}".format(random.randint(0, 100000)),
+            "user_id": str(random.randint(1, 30000000)),
+            "pp_raw": str(random.uniform(0, 20000)),
+            "pp_rank": str(random.randint(0, 2000000)),
+            "total_seconds_played": str(random.randint(0, 10**7)),
+            "playcount": str(random.randint(0, 10**6)),
+            "country": "US",
+            "join_date": "2015-04-15 01:44:28",
+        }
+        plays = [
+            (
+                random_play(mode),
+                {
+                    "score_id": str(random.randint(1, 4 * 10**9)),
+                    "replay_available": random.choice(["0", "1"]),
+                },
+                {"title": "Some Map [Insane]"},
+            )
+            for _ in range(5)
+        ]
+        links = "All previous reports: " + " | ".join(
+            "[[{}]](https://redd.it/abcdef)".format(i)
+            for i in range(1, random.randint(1, 50))
+        )
+        inputs.append((user_data, plays, links, mode))
+    return inputs
+
+
+def bench(name, function, items, repeat):
+    """
+    Calls function on each item repeat times, then prints the throughput and the slowest single call.
+    """
+
+    worst = 0
+    worst_item = None
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            call_start = time.perf_counter()
+            function(item)
+            elapsed = time.perf_counter() - call_start
+            if elapsed > worst:
+                worst = elapsed
+                worst_item = item
+    total = time.perf_counter() - start
+
+    worst_input = repr(worst_item)
+    if len(worst_input) > 60:
+        worst_input = worst_input[:57] + "..."
+    print(
+        "{:<22} {:>8,} calls {:>12,.0f}/s   worst {:>9.1f}us on {}".format(
+            name,
+            len(items) * repeat,
+            len(items) * repeat / total,
+            worst * 10**6,
+            worst_input,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--corpus",
+        help="file with additional titles to benchmark, one per line (eg exported from the subreddit)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=20,
+        help="how many times to run through each set of input",
+    )
+    args = parser.parse_args()
+
+    random.seed(0)  # the same input every run, so runs are comparable
+    titles = list(TITLES)
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            titles += [line.rstrip("\n") for line in f if line.strip()]
+    titles = [title.lower() for title in titles]  # like RedditBound#title
+    adversarial = [title.lower() for title in adversarial_titles()]
+
+    mods = [random.randint(0, 1 << 30) for _ in range(1000)]
+    plays = [(random_play(mode), mode) for mode in range(4) for _ in range(250)]
+
+    bench("parse_title_data", parse_title_data, titles, args.repeat)
+    bench("parse_title_data (adv)", parse_title_data, adversarial, args.repeat)
+    bench("calc_mods", calc_mods, mods, args.repeat)
+    bench("calc_acc", lambda item: calc_acc(*item), plays, args.repeat)
+    bench(
+        "render_reply",
+        lambda item: render_reply(*item),
+        random_reply_inputs(200),
+        args.repeat,
+    )
+
+
+if __name__ == "__main__":
+    main()
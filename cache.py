@@ -0,0 +1,198 @@
+import os
+import time
+import pickle
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A thread safe in-memory cache that evicts the least recently used entry once it holds more than size entries.
+
+    Attributes:
+        Integer size: The maximum number of entries to hold.
+        OrderedDict entries: The cached entries, from least to most recently used.
+    """
+
+    def __init__(self, size):
+        """
+        Initializes an LRUCache instance.
+
+        Args:
+            Integer size: The maximum number of entries to hold.
+        """
+
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the value cached under key, or None if there isn't one.
+        """
+
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        """
+        Caches value under key, evicting the least recently used entry if the cache is full.
+        """
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class TTLCache(LRUCache):
+    """
+    An LRUCache whose entries also expire ttl seconds after they were cached.
+
+    Attributes:
+        Integer size: The maximum number of entries to hold.
+        Float ttl: How many seconds an entry stays valid for.
+        OrderedDict entries: The cached (expiry time, value) pairs, from least to most recently used.
+    """
+
+    def __init__(self, size, ttl):
+        """
+        Initializes a TTLCache instance.
+
+        Args:
+            Integer size: The maximum number of entries to hold.
+            Float ttl: How many seconds an entry stays valid for.
+        """
+
+        super().__init__(size)
+        self.ttl = ttl
+
+    def get(self, key):
+        """
+        Returns the value cached under key, or None if there isn't one or it has expired.
+        """
+
+        with self.lock:
+            if key not in self.entries:
+                return None
+            expires, value = self.entries[key]
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Caches value under key for ttl seconds, evicting the least recently used entry if the cache is full.
+        """
+
+        super().put(key, (time.monotonic() + self.ttl, value))
+
+
+class ReplayCache:
+    """
+    Caches loaded circleguard replays on disk, keyed by score id.
+
+    Evicts the least recently used replays once the cache takes up more than size bytes. Replays are
+    written atomically, so the cache can be shared by several processes.
+
+    Attributes:
+        String path: The directory replays are cached in.
+        Integer size: The maximum number of bytes the cached replays may take up.
+    """
+
+    log = logging.getLogger()
+
+    def __init__(self, path, size):
+        """
+        Initializes a ReplayCache instance, creating its directory if necessary.
+
+        Args:
+            String path: The directory replays are cached in.
+            Integer size: The maximum number of bytes the cached replays may take up.
+        """
+
+        self.path = path
+        self.size = size
+        os.makedirs(path, exist_ok=True)
+
+    def load(self, cg, score_id):
+        """
+        Returns the loaded replay for the given score id, downloading it with the given Circleguard if it isn't cached.
+        """
+
+        from circleguard import ReplayID
+
+        path = os.path.join(self.path, "{}.pickle".format(score_id))
+        try:
+            with open(path, "rb") as f:
+                replay = pickle.load(f)
+            os.utime(path)  # mark as recently used
+            return replay
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            ReplayCache.log.warning(
+                "Discarding unreadable cached replay {}: {}".format(score_id, str(e))
+            )
+            os.remove(path)
+
+        replay = ReplayID(score_id)
+        cg.load(replay)
+        self.store(path, replay)
+        return replay
+
+    def store(self, path, replay):
+        """
+        Writes the given replay to the given path in the cache, then evicts replays if the cache is too big.
+        """
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(replay, f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            ReplayCache.log.warning(
+                "Couldn't cache replay at {}: {}".format(path, str(e))
+            )
+            os.remove(tmp_path)
+            return
+        except BaseException:
+            # interrupted (eg by the similarity deadline), which isn't ours to handle
+            os.remove(tmp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used replays until the cache takes up at most size bytes.
+        """
+
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith(".pickle"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
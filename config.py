@@ -1,10 +1,18 @@
+import os
 import re
 
 # General Config
 DB_PATH = "db.db"  # relative path to database
+DB_TIMEOUT = 30  # seconds to wait on a locked database before giving up
+DB_CACHE_KIB = 16 * 1024  # sqlite page cache size per connection
 SUB = "osureport"  # listen for submissions to this sub
-API_BASE = "https://osu.ppy.sh/api/"
+# where the osu api and reddit live. Only overridden (through the environment) to point the bot at
+# fake_server.py when load testing, see loadtest.py
+API_BASE = os.environ.get("OSU_REPORTER_API_BASE", "https://osu.ppy.sh/api/")
+REDDIT_URL = os.environ.get("OSU_REPORTER_REDDIT_URL", "https://www.reddit.com")
+OAUTH_URL = os.environ.get("OSU_REPORTER_OAUTH_URL", "https://oauth.reddit.com")
 API_USERS = "https://osu.ppy.sh/users/"
+API_TIMEOUT = 15  # seconds to wait on the osu api before giving up on a request
 AUTHOR = "tybug2"  # reddit user to forward replies and dms to
 LIMIT_DAYS = 3  # disallow new reports on the same user within this many days
 LIMIT_CHECK = 30  # check for restrictions much less frequently after this many days
@@ -12,6 +20,21 @@ LIMIT_CHECK_INFREQUENT = (
     30 * 6
 )  # stop checking for restrictions after this many days. half a year
 LIMIT_TOP_PLAYS = 5  # how many top plays to provide pp data for
+REPLY_WORKERS = 2 * LIMIT_TOP_PLAYS  # max concurrent api lookups when building a reply
+USER_CACHE_SIZE = 200  # how many users' profiles and top plays to keep cached
+USER_CACHE_TTL = 10 * 60  # seconds a cached user stays valid for
+SIMILARITY_WORKERS = 2  # processes calculating replay similarity
+SIMILARITY_TIMEOUT = 10  # seconds to wait on the similarity before replying without it
+SIMILARITY_DEADLINE = (
+    5 * 60
+)  # seconds a similarity worker spends on a job before giving up on it
+REPLAY_CACHE_PATH = "replays"  # relative path to the directory replays are cached in
+REPLAY_CACHE_SIZE = 200 * 1024 * 1024  # max bytes of replays to keep cached
+BEATMAP_CACHE_SIZE = 1000  # how many beatmaps to keep cached in memory
+BEATMAP_IMMUTABLE = [
+    "1",
+    "2",
+]  # ranked and approved; data for maps with these statuses is cached
 VERSION = "2.7.3"
 
 
@@ -66,7 +89,34 @@ REPLY_IGNORE = [
     "[meta]",
 ]  # don't comment if the title contains these
 
+# how many reports to process at once, and how many each can have waiting before the submission stream pauses.
+# Reports on the same user are always processed in order, by the same worker
+INTAKE_WORKERS = 4
+INTAKE_QUEUE_SIZE = 25
+# seconds to wait before restarting the submission stream after it fails, doubling every time in a row it fails
+STREAM_BACKOFF_MIN = 5
+STREAM_BACKOFF_MAX = 5 * 60
+
 CHECK_INTERVAL = 15  # Check for banned users every 15 minutes
+# How often to check a report for a restriction, by how old it is: [(max age in days, seconds between checks), ...].
+# Reports older than the last age aren't checked anymore. No report is checked more than every CHECK_INTERVAL
+CHECK_SCHEDULE = [
+    (1, CHECK_INTERVAL * 60),
+    (7, 60 * 60),
+    (LIMIT_CHECK, 4 * 60 * 60),
+    (LIMIT_CHECK_INFREQUENT, 24 * 60 * 60),
+]
+CHECK_BLATANT_FACTOR = 0.5  # blatant reports get restricted sooner, check them more
+# every report after the first on the same user shortens the time between checks by this much (up to 4 times)
+CHECK_REPORTED_FACTOR = 0.75
+SHERIFF_WORKERS = 8  # how many users to probe for restrictions concurrently
+API_MAX_IN_FLIGHT = 8  # max osu api requests in flight at once, across all threads
+# max low priority (sheriff) requests in flight, so the rest of API_MAX_IN_FLIGHT is always free for new reports
+API_LOW_IN_FLIGHT = 4
+API_RATE_LIMIT = 1000  # max osu api requests per minute (peppy allows 1200)
+API_BURST = 60  # requests that can be made at once after the api has been idle
+# upper bounds, in seconds, of the buckets latencies are counted into for the metrics endpoint (see metrics.py)
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
 
 # Comment Config
 # Appended to every comment
@@ -113,6 +163,11 @@ REJECT_MALFORMATTED = "malformatted"
 REJECT_RESTRICTED = "already_restricted"
 REJECT_REPORTED = "already_reported"
 
+# results of parser#probe_user
+USER_EXISTS = "exists"
+USER_RESTRICTED = "restricted"  # or never existed in the first place
+USER_ERROR = "error"
+
 
 # Full credit for these two to Christoper (https://github.com/christopher-dG/osu-bot)
 MODS_INT = {
@@ -1,7 +1,302 @@
 import sqlite3
-from config import DB_PATH, LIMIT_DAYS, LIMIT_CHECK, LIMIT_CHECK_INFREQUENT
+from config import (
+    DB_PATH,
+    DB_TIMEOUT,
+    DB_CACHE_KIB,
+    LIMIT_DAYS,
+    LIMIT_CHECK_INFREQUENT,
+)
+from utils import next_check
 import functools
+import contextlib
+import threading
 import time
+import json
+import logging
+
+log = logging.getLogger()
+
+
+# Schema migrations, applied in order on startup. Applying MIGRATIONS[i] brings the database to
+# schema version i + 1, which is stored in PRAGMA user_version.
+MIGRATIONS = [
+    # 1: create the original tables if this is a fresh database, then rebuild USERS with numeric
+    # timestamps (REPORTED_UTC used to be a VARCHAR) and index it for the report and sheriff lookups
+    """
+    CREATE TABLE IF NOT EXISTS "SUBMISSIONS" (
+        `ID`	VARCHAR ( 8 ) NOT NULL,
+        `REJECTED`	BIT(1),
+        `REASON`	TEXT,
+        `RESTRICTED`	BIT ( 1 ),
+        PRIMARY KEY(`ID`)
+    );
+    CREATE TABLE IF NOT EXISTS "USERS" (
+        `POST_ID`	VARCHAR ( 10 ) NOT NULL,
+        `USER_ID`	VARCHAR ( 10 ) NOT NULL,
+        `REPORTED_UTC`	VARCHAR ( 10 ) NOT NULL,
+        `RESTRICTED_UTC`	TEXT,
+        `OFFENSE_TYPE`	TEXT NOT NULL,
+        `BLATANT`	BIT ( 1 ) NOT NULL,
+        `REPORTEE`	TEXT NOT NULL,
+        PRIMARY KEY(`POST_ID`)
+    );
+    CREATE TABLE "USERS_NEW" (
+        `POST_ID`	VARCHAR ( 10 ) NOT NULL,
+        `USER_ID`	VARCHAR ( 10 ) NOT NULL,
+        `REPORTED_UTC`	REAL NOT NULL,
+        `RESTRICTED_UTC`	REAL,
+        `OFFENSE_TYPE`	TEXT NOT NULL,
+        `BLATANT`	BIT ( 1 ) NOT NULL,
+        `REPORTEE`	TEXT NOT NULL,
+        PRIMARY KEY(`POST_ID`)
+    );
+    INSERT INTO USERS_NEW
+        SELECT POST_ID, USER_ID, CAST(REPORTED_UTC AS REAL),
+            CASE WHEN RESTRICTED_UTC IS NULL OR RESTRICTED_UTC = 'n/a' THEN NULL
+                ELSE CAST(RESTRICTED_UTC AS REAL) END,
+            OFFENSE_TYPE, BLATANT, REPORTEE
+        FROM USERS;
+    DROP TABLE USERS;
+    ALTER TABLE USERS_NEW RENAME TO USERS;
+    CREATE INDEX USERS_USER_ID ON USERS(USER_ID, REPORTED_UTC);
+    CREATE INDEX USERS_RESTRICTED ON USERS(RESTRICTED_UTC, REPORTED_UTC);
+    """,
+    # 2: cache of beatmap data from the api, for maps whose data can't change anymore
+    """
+    CREATE TABLE "BEATMAPS" (
+        `BEATMAP_ID`	VARCHAR ( 10 ) NOT NULL,
+        `DATA`	TEXT NOT NULL,
+        `CACHED_UTC`	REAL NOT NULL,
+        PRIMARY KEY(`BEATMAP_ID`)
+    );
+    """,
+    # 3: when each unrestricted report should next be checked for a restriction (see utils#next_check).
+    # Every report recent enough to still be checked is due immediately, the first sweep reschedules them
+    """
+    ALTER TABLE USERS ADD COLUMN `NEXT_CHECK_AT` REAL;
+    UPDATE USERS SET NEXT_CHECK_AT = REPORTED_UTC
+        WHERE RESTRICTED_UTC IS NULL AND REPORTED_UTC > CAST(strftime('%s', 'now') AS REAL) - {};
+    CREATE INDEX USERS_NEXT_CHECK ON USERS(NEXT_CHECK_AT);
+    """.format(LIMIT_CHECK_INFREQUENT * 24 * 60 * 60),
+    # 4: daily statistics, kept up to date by add_user and restrict_user so --stats only reads the rows of the days
+    # it covers instead of scanning USERS.
+    # Days are utc "YYYY-MM-DD" strings of REPORTED_UTC; restrictions count towards the day of the report
+    """
+    CREATE TABLE "STATS_DAILY" (
+        `DAY`	TEXT NOT NULL,
+        `REPORTS`	INTEGER NOT NULL DEFAULT 0,
+        `BLATANT`	INTEGER NOT NULL DEFAULT 0,
+        `RESTRICTED`	INTEGER NOT NULL DEFAULT 0,
+        `BLATANT_RESTRICTED`	INTEGER NOT NULL DEFAULT 0,
+        `RESTRICTION_SECONDS`	REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY(`DAY`)
+    );
+    CREATE TABLE "STATS_REPORTEES" (
+        `DAY`	TEXT NOT NULL,
+        `REPORTEE`	TEXT NOT NULL,
+        `REPORTS`	INTEGER NOT NULL DEFAULT 0,
+        `BLATANT`	INTEGER NOT NULL DEFAULT 0,
+        `RESTRICTED`	INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(`DAY`, `REPORTEE`)
+    );
+    INSERT INTO STATS_DAILY
+        SELECT date(REPORTED_UTC, 'unixepoch'), COUNT(*), SUM(BLATANT = 'true'),
+            SUM(RESTRICTED_UTC IS NOT NULL), SUM(BLATANT = 'true' AND RESTRICTED_UTC IS NOT NULL),
+            TOTAL(RESTRICTED_UTC - REPORTED_UTC)
+        FROM USERS GROUP BY 1;
+    INSERT INTO STATS_REPORTEES
+        SELECT date(REPORTED_UTC, 'unixepoch'), REPORTEE, COUNT(*), SUM(BLATANT = 'true'),
+            SUM(RESTRICTED_UTC IS NOT NULL)
+        FROM USERS GROUP BY 1, 2;
+    """,
+    # 5: whether the author deleted the submission, so the duplicate check never has to ask reddit
+    # (see Sheriff#refresh_deleted)
+    """
+    ALTER TABLE SUBMISSIONS ADD COLUMN `DELETED` BIT ( 1 ) NOT NULL DEFAULT 0;
+    """,
+    # 6: covers get_top_reportees, so it reads the window's rows from the index alone
+    """
+    CREATE INDEX STATS_REPORTEES_DAY ON STATS_REPORTEES(DAY, REPORTEE, REPORTS, BLATANT, RESTRICTED);
+    """,
+]
+
+
+def migrate(conn):
+    """
+    Brings the database up to the latest schema version by applying any outstanding MIGRATIONS.
+
+    Each migration runs in its own transaction, so an interrupted upgrade leaves the database at the
+    previous version. Never runs for leadless or read only connections (see ConnectionManager), which
+    refuse to open an outdated database instead, see check_schema.
+    """
+
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        log.info("Migrating database to schema version {}".format(i))
+        try:
+            conn.executescript(
+                "BEGIN;{}PRAGMA user_version = {};COMMIT;".format(migration, i)
+            )
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+
+class SchemaOutdated(sqlite3.DatabaseError):
+    """
+    Raised when opening a database that needs migrating without being allowed to migrate it.
+    """
+
+
+def check_schema(conn, hint):
+    """
+    Raises SchemaOutdated (ending in the given hint on how to migrate) if the database isn't at the latest schema version.
+    """
+
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < len(MIGRATIONS):
+        raise SchemaOutdated(
+            "database is at schema version {} instead of {}; {}".format(
+                version, len(MIGRATIONS), hint
+            )
+        )
+
+
+class SubmissionIds:
+    """
+    The ids of every submission in the SUBMISSIONS table, kept in memory so checking whether a submission was
+    already processed (every time the stream restarts, and on every sweep) doesn't need a query.
+
+    Reddit's ids are base36, and are stored as the integers they encode, which take about half the memory of the
+    strings. Loaded in bulk from the table once, then added to as the transactions adding submissions commit.
+
+    Attributes:
+            Set ids: The ids, as integers.
+            Boolean loaded: Whether the ids have been loaded from the table yet.
+    """
+
+    def __init__(self):
+        self.ids = set()
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(post_id):
+        try:
+            return int(post_id, 36)
+        except ValueError:
+            return post_id
+
+    def load(self, conn):
+        """
+        Loads every id in the SUBMISSIONS table of the given connection's database, unless they're loaded already.
+        """
+
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            self.ids.update(
+                SubmissionIds.key(row[0])
+                for row in conn.execute("SELECT id FROM submissions")
+            )
+            self.loaded = True
+
+    def update(self, post_ids):
+        with self.lock:
+            self.ids.update(SubmissionIds.key(post_id) for post_id in post_ids)
+
+    def __contains__(self, post_id):
+        return SubmissionIds.key(post_id) in self.ids
+
+
+class ConnectionManager:
+    """
+    Hands out one connection to the database per thread, which that thread reuses for as long as it lives.
+
+    Connections run in WAL mode, so readers never block the writer (and vice versa) and the stream
+    and sheriff threads can use the database at the same time without "database is locked" errors.
+    The schema is migrated when the first connection is opened, unless leadless or read_only is set.
+
+    Attributes:
+            String path: The path to the database.
+            Boolean leadless: Whether to leave the database file as is (--leadless): no migrations and no switching
+                              it to WAL. Only affects connections opened after it's set.
+            Boolean read_only: Whether to open connections read only (and without migrating), for --stats.
+                               Only affects connections opened after it's set.
+            Local local: Holds the current thread's connection, cursor, transaction depth, and the ids of the
+                         submissions added in its current transaction.
+            SubmissionIds submissions: The ids of the submissions in the database, shared by every thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.migrated = False
+        self.leadless = False
+        self.read_only = False
+        self.submissions = SubmissionIds()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_TIMEOUT)
+        if not self.leadless:
+            conn.execute("PRAGMA journal_mode=WAL")
+        # durable across application crashes; only an os crash can lose the last few commits
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-{}".format(DB_CACHE_KIB))
+
+        with self.lock:
+            if not self.migrated:
+                if self.leadless:
+                    try:
+                        check_schema(
+                            conn, "run the bot without --leadless once to migrate it"
+                        )
+                    except SchemaOutdated:
+                        conn.close()
+                        raise
+                else:
+                    migrate(conn)
+                self.migrated = True
+        return conn
+
+    def connect_read_only(self):
+        """
+        Opens a connection sqlite won't write through. The schema isn't migrated, so it has to be up to date already.
+        """
+
+        conn = sqlite3.connect(
+            "file:{}?mode=ro".format(self.path), uri=True, timeout=DB_TIMEOUT
+        )
+        conn.execute("PRAGMA cache_size=-{}".format(DB_CACHE_KIB))
+        try:
+            check_schema(conn, "run the bot once to migrate it")
+        except SchemaOutdated:
+            conn.close()
+            raise
+        return conn
+
+    def state(self):
+        """
+        Returns the current thread's connection state, connecting first if this thread hasn't yet.
+        """
+
+        if not hasattr(self.local, "conn"):
+            conn = self.connect_read_only() if self.read_only else self.connect()
+
+            self.local.conn = conn
+            self.local.cursor = conn.cursor()
+            self.local.depth = (
+                0  # how many transaction blocks we're currently nested in
+            )
+            # only shared with the other threads (in submissions) once the transaction adding them commits
+            self.local.added = []
+        return self.local
+
+
+connections = ConnectionManager(DB_PATH)
 
 
 # only executes the function if leadless is false
@@ -27,30 +322,68 @@ class DB:
     Manages read/write intercations with the database.
 
     Attributes:
-            Connection conn: The database connection.
-            Cursor c = The database cursor.
+            Connection conn: The database connection for the current thread.
+            Cursor c = The database cursor for the current thread.
             Boolean leadless: True if the instance should not write to the database, False otherwise.
             Float LIMIT_SECONDS: The threshold, in seconds, for reported_utc when fetching recent users.
     """
 
     LIMIT_SECONDS = LIMIT_DAYS * 24 * 60 * 60
-    LIMIT_CHECK_SECONDS = LIMIT_CHECK * 24 * 60 * 60
-    LIMIT_CHECK_INFREQUENT_SECONDS = LIMIT_CHECK_INFREQUENT * 24 * 60 * 60
 
     def __init__(self, leadless):
         """
         Initalizes a DB instance.
 
         Attributes:
-                Connection conn: The database connection.
-                Cursor c = The database cursor.
                 Boolean leadless: True if the instance should not write to the database, False otherwise.
         """
 
-        self.conn = sqlite3.connect(DB_PATH)
-        self.c = self.conn.cursor()
         self.leadless = leadless
 
+    @property
+    def conn(self):
+        return connections.state().conn
+
+    @property
+    def c(self):
+        return connections.state().cursor
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Groups every write made inside the with block into a single commit.
+
+        If the block raises, all writes made inside it are rolled back and the exception is re-raised.
+        Transactions can be nested; only the outermost block commits or rolls back.
+        Transactions are per thread, like the connections they run on.
+        """
+
+        state = connections.state()
+        state.depth += 1
+        try:
+            yield self
+        except BaseException:
+            state.depth -= 1
+            if state.depth == 0:
+                state.conn.rollback()
+                state.added.clear()
+            raise
+
+        state.depth -= 1
+        self.commit()
+
+    def commit(self):
+        """
+        Commits the pending writes, unless we're inside a transaction block (which commits on exit instead).
+        """
+
+        state = connections.state()
+        if state.depth == 0:
+            state.conn.commit()
+            if state.added:
+                connections.submissions.update(state.added)
+                state.added.clear()
+
     # Submissions
     @check
     def add_submission(self, post_id):
@@ -64,9 +397,11 @@ class DB:
         """
 
         self.c.execute(
-            "INSERT INTO submissions VALUES(?, ?, ?, ?)", [post_id, None, None, False]
+            "INSERT INTO submissions(ID, REJECTED, REASON, RESTRICTED) VALUES(?, ?, ?, ?)",
+            [post_id, None, None, False],
         )
-        self.conn.commit()
+        connections.state().added.append(post_id)
+        self.commit()
 
     @check
     def reject_submission(self, post_id, reason):
@@ -86,7 +421,7 @@ class DB:
             "UPDATE submissions SET rejected=?, reason=? WHERE id=?",
             [True, reason, post_id],
         )
-        self.conn.commit()
+        self.commit()
 
     def restrict_submission(self, post_id):
         """
@@ -101,103 +436,259 @@ class DB:
         self.c.execute(
             "UPDATE submissions SET restricted=? WHERE id=?", [True, post_id]
         )
-        self.conn.commit()
+        self.commit()
+
+    @check
+    def mark_deleted(self, post_id):
+        """
+        Marks a submission as deleted by its author, so it's no longer linked as the previous report of a duplicate
+
+        Args:
+                String post_id: The post_id of the deleted submission
+        """
+
+        self.c.execute("UPDATE submissions SET deleted=? WHERE id=?", [True, post_id])
+        self.commit()
+
+    def get_linkable_submissions(self):
+        """
+        Returns the post_ids of the submissions Report#check_duplicate could return (reported within the past LIMIT_SECONDS),
+        that aren't known to be deleted.
+        """
+
+        return [
+            row[0]
+            for row in self.c.execute(
+                "SELECT users.post_id FROM users JOIN submissions ON submissions.id = users.post_id "
+                "WHERE users.reported_utc > ? AND NOT submissions.deleted",
+                [time.time() - DB.LIMIT_SECONDS],
+            )
+        ]
 
     def submission_exists(self, post_id):
         """
         Checks if a submission exists
 
-        Returns True if a submission exists in the SUBMISSIONS table with the given post_id, False otherwise
+        Returns True if a submission exists in the SUBMISSIONS table with the given post_id, False otherwise.
+        Answered from memory (see SubmissionIds), loading every id from the table on first use.
 
         Args:
                 String post_id: the post_id to check for the existence of
         """
 
-        return (
-            True
-            if self.c.execute(
-                "SELECT * FROM submissions WHERE id=?", [post_id]
-            ).fetchone()
-            else False
-        )
+        self.load_submissions()
+        return post_id in connections.submissions
+
+    def load_submissions(self):
+        """
+        Loads the ids of every submission into memory for submission_exists, if they aren't already.
+        """
+
+        connections.submissions.load(self.conn)
 
     # Users
     @check
     def add_user(self, post_id, user_id, reported_utc, offense_type, blatant, reportee):
         """
-        Adds a user to the USERS table with the given information
+        Adds a user to the USERS table with the given information, and schedules its first restriction check
+        (see utils#next_check)
 
         Args:
                 String post_id: The post_id of the entry
                 String user_id: The user_id of the entry
-                String reported_utc: The unix timestamp the user was reported at
+                Float reported_utc: The unix timestamp the user was reported at
                 String offense_type: What the user was reported for
                 Boolean blatant: Whether the report called the cheats blatant or not
                 String reportee: The reddit username of the reportee (not including the "u/")
         """
 
-        data = [post_id, user_id, reported_utc, None, offense_type, blatant, reportee]
-        self.c.execute("INSERT INTO users VALUES(?, ?, ?, ?, ?, ?, ?)", data)
-        self.conn.commit()
+        reports = (
+            self.c.execute(
+                "SELECT COUNT(*) FROM users WHERE user_id=?", [user_id]
+            ).fetchone()[0]
+            + 1
+        )
+        data = [
+            post_id,
+            user_id,
+            reported_utc,
+            offense_type,
+            blatant,
+            reportee,
+            next_check(reported_utc, blatant, reports),
+        ]
+        self.c.execute(
+            "INSERT INTO users(POST_ID, USER_ID, REPORTED_UTC, OFFENSE_TYPE, BLATANT, REPORTEE, NEXT_CHECK_AT) "
+            "VALUES(?, ?, ?, ?, ?, ?, ?)",
+            data,
+        )
+        self.add_stats(
+            reported_utc, reportee, reports=1, blatant=int(blatant == "true")
+        )
+        self.commit()
 
     @check
     def restrict_user(self, post_id, time_utc):
         """
         Restricts the user reported in the given post_id
 
-        Updates the USERS table with the given post_id to have a restricted_utc of the passed time
+        Updates the USERS table with the given post_id to have a restricted_utc of the passed time,
+        unschedules any further restriction checks, and counts the restriction in the daily statistics
 
         Args:
                 String post_id: The post_id of the report to restrict
-                String time_utc: The time the user was reported at
+                Float time_utc: The time the user was restricted at
         """
 
+        row = self.c.execute(
+            "SELECT reported_utc, restricted_utc, blatant, reportee FROM users WHERE post_id=?",
+            [post_id],
+        ).fetchone()
+        if row:
+            reported_utc, restricted_utc, blatant, reportee = row
+            # a report can be resolved again if the user got unrestricted and restricted again,
+            # only the restriction time changes then
+            newly = int(restricted_utc is None)
+            self.add_stats(
+                reported_utc,
+                reportee,
+                restricted=newly,
+                blatant_restricted=newly * int(blatant == "true"),
+                restriction_seconds=time_utc - (restricted_utc or reported_utc),
+            )
         self.c.execute(
-            "UPDATE users SET RESTRICTED_UTC=? WHERE post_id=?", [time_utc, post_id]
+            "UPDATE users SET RESTRICTED_UTC=?, NEXT_CHECK_AT=NULL WHERE post_id=?",
+            [time_utc, post_id],
         )
-        self.conn.commit()
+        self.commit()
 
-    def user_exists(self, user_id):
+    @check
+    def reschedule_user(self, post_id, next_check_at):
         """
-        Checks if a user exists.
+        Sets when the report with the given post_id should next be checked for a restriction
 
-        Checks if a user exists in the USERS table that was reported within the past LIMIT_SECONDS (equivelant to LIMIT_DAYS) seconds.
+        Args:
+                String post_id: The post_id of the report to reschedule
+                Float next_check_at: The unix timestamp to check it at, or None to never check it again
+        """
 
-        Returns:
-                The post_id of the entry if an entry meeting criteria was found,
-                or None otherwise.
+        self.c.execute(
+            "UPDATE users SET NEXT_CHECK_AT=? WHERE post_id=?", [next_check_at, post_id]
+        )
+        self.commit()
+
+    def user_history(self, user_id):
         """
+        Returns the reports on the user with the given user_id as (post_id, reported_utc, deleted), oldest first.
+        deleted is whether the author deleted the report (see mark_deleted).
 
-        result = self.c.execute(
-            "SELECT * FROM users WHERE user_id=? AND reported_utc > ?",
-            [user_id, time.time() - DB.LIMIT_SECONDS],
-        ).fetchone()
-        return result[0] if result else None
+        Args:
+                String user_id: The id of the reported user
+        """
 
-    def get_recent_users(self):
+        return self.c.execute(
+            "SELECT users.post_id, users.reported_utc, COALESCE(submissions.deleted, 0) "
+            "FROM users LEFT JOIN submissions ON submissions.id = users.post_id "
+            "WHERE users.user_id=? ORDER BY users.reported_utc",
+            [user_id],
+        ).fetchall()
+
+    def get_due_users(self):
         """
-        Gets recently reported users.
+        Gets users due for a restriction check.
 
-        Retrives users that were reported within the past LIMIT_SECONDS seconds, and are not restricted yet.
+        Retrives unrestricted users whose next check (see utils#next_check) is now or in the past, longest overdue first.
 
         Returns:
                 The values in the columns of the users table that meet the criteria.
         """
 
+        # restricted users never have a next check (see restrict_user), so this is a single index range scan
         return self.c.execute(
-            "SELECT * FROM users WHERE reported_utc > ? AND restricted_utc IS NULL",
-            [time.time() - DB.LIMIT_CHECK_SECONDS],
+            "SELECT * FROM users WHERE next_check_at <= ? ORDER BY next_check_at",
+            [time.time()],
         ).fetchall()
 
-    def get_recentish_users(self):
+    # Statistics
+    def add_stats(
+        self,
+        reported_utc,
+        reportee,
+        reports=0,
+        blatant=0,
+        restricted=0,
+        blatant_restricted=0,
+        restriction_seconds=0,
+    ):
+        """
+        Adds the given counts to the STATS_DAILY and STATS_REPORTEES rows of the (utc) day reported_utc falls on.
+
+        Doesn't commit, since it only ever runs as part of add_user or restrict_user.
+        """
+
+        day = self.c.execute("SELECT date(?, 'unixepoch')", [reported_utc]).fetchone()[
+            0
+        ]
+        self.c.execute("INSERT OR IGNORE INTO stats_daily(day) VALUES(?)", [day])
+        self.c.execute(
+            "UPDATE stats_daily SET reports = reports + ?, blatant = blatant + ?, restricted = restricted + ?, "
+            "blatant_restricted = blatant_restricted + ?, restriction_seconds = restriction_seconds + ? "
+            "WHERE day=?",
+            [
+                reports,
+                blatant,
+                restricted,
+                blatant_restricted,
+                restriction_seconds,
+                day,
+            ],
+        )
+        self.c.execute(
+            "INSERT OR IGNORE INTO stats_reportees(day, reportee) VALUES(?, ?)",
+            [day, reportee],
+        )
+        self.c.execute(
+            "UPDATE stats_reportees SET reports = reports + ?, blatant = blatant + ?, restricted = restricted + ? "
+            "WHERE day=? AND reportee=?",
+            [reports, blatant, restricted, day, reportee],
+        )
+
+    def get_stats(self, since, until):
+        """
+        Sums the daily statistics of reports made between the given days.
+
+        Args:
+                String since: The first day to include, as a utc "YYYY-MM-DD" string
+                String until: The last day to include, as a utc "YYYY-MM-DD" string
+
+        Returns:
+                [reports, blatant reports, restrictions, blatant restrictions, total seconds from report to restriction]
+        """
+
+        return list(
+            self.c.execute(
+                "SELECT COALESCE(SUM(reports), 0), COALESCE(SUM(blatant), 0), COALESCE(SUM(restricted), 0), "
+                "COALESCE(SUM(blatant_restricted), 0), TOTAL(restriction_seconds) "
+                "FROM stats_daily WHERE day BETWEEN ? AND ?",
+                [since, until],
+            ).fetchone()
+        )
+
+    def get_top_reportees(self, since, until, limit):
         """
-        Users which have been reported recently and are not restricted yet, but
-        in a larger time frame than ``get_recent_users``. These users will
-        be checked less frequently than ``get_recent_users``.
+        Gets the reportees with the most reports made between the given days (utc "YYYY-MM-DD" strings, inclusive).
+        Groups every STATS_REPORTEES row in the window (one per reportee per day), read from the
+        STATS_REPORTEES_DAY index alone, so it grows with the window rather than with USERS.
+
+        Returns:
+                [reportee, reports, blatant reports, reports that got restricted] for each of the top limit reportees, most reports first.
         """
+
         return self.c.execute(
-            "SELECT * FROM users WHERE reported_utc > ? AND restricted_utc IS NULL",
-            [time.time() - DB.LIMIT_CHECK_INFREQUENT_SECONDS],
+            "SELECT reportee, SUM(reports) AS total, SUM(blatant), SUM(restricted) "
+            "FROM stats_reportees WHERE day BETWEEN ? AND ? "
+            "GROUP BY reportee ORDER BY total DESC LIMIT ?",
+            [since, until, limit],
         ).fetchall()
 
     # Misc
@@ -209,3 +700,30 @@ class DB:
         return self.c.execute(
             "SELECT * FROM users WHERE user_id=?", [user_id]
         ).fetchall()
+
+    # Beatmaps
+    @check
+    def add_beatmap(self, beatmap_id, data):
+        """
+        Caches the api's data for a beatmap in the BEATMAPS table, replacing any previously cached data.
+
+        Args:
+                String beatmap_id: The id of the beatmap
+                Dict data: The beatmap's entry in the get_beatmaps response
+        """
+
+        self.c.execute(
+            "INSERT OR REPLACE INTO beatmaps VALUES(?, ?, ?)",
+            [beatmap_id, json.dumps(data), time.time()],
+        )
+        self.commit()
+
+    def get_beatmap(self, beatmap_id):
+        """
+        Returns the cached api data for the given beatmap, or None if it isn't cached.
+        """
+
+        result = self.c.execute(
+            "SELECT data FROM beatmaps WHERE beatmap_id=?", [beatmap_id]
+        ).fetchone()
+        return json.loads(result[0]) if result else None
@@ -0,0 +1,442 @@
+"""
+A local stand-in for reddit and the osu! api, implementing just the endpoints the bot uses.
+
+Reddit: oauth login, the subreddit's new submissions (which the submission stream polls), fetching
+submissions, reply, distinguish, flair, remove, approve, edit, the inbox, and the spam queue.
+osu!: get_user, get_user_best, get_scores and get_beatmaps, with made up but stable data for every user.
+
+Every request can be slowed down and failed on purpose, see FakeState. Point the bot at it with the
+OSU_REPORTER_API_BASE, OSU_REPORTER_REDDIT_URL and OSU_REPORTER_OAUTH_URL environment variables
+(loadtest.py does this for you).
+
+Usage: python fake_server.py [--port 8080] [--latency 50] [--jitter 20] [--error-rate 0.01]
+New submissions can then be posted with POST /fake/submit?title=...&selftext=...
+"""
+
+import re
+import json
+import time
+import random
+import zlib
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BASE36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def base36(number):
+    digits = ""
+    while number:
+        number, digit = divmod(number, 36)
+        digits = BASE36[digit] + digits
+    return digits or "0"
+
+
+def listing(children):
+    return {
+        "kind": "Listing",
+        "data": {"children": children, "after": None, "before": None, "dist": None},
+    }
+
+
+class FakeState:
+    """
+    Everything the fake server knows about, shared between its request threads.
+
+    Attributes:
+        String sub: The subreddit submissions are posted to.
+        Float latency: Mean seconds to wait before answering any request.
+        Float jitter: Standard deviation of the wait, in seconds.
+        Float error_rate: Chance for any request to fail with a 500.
+        Float restricted_rate: Chance for any osu! user to be restricted (get_user returns nothing).
+        Dict submissions: {id: submission data}, oldest first.
+        Dict comments: {id: comment data}.
+        Dict posted_at: {submission id: time.time() it was posted}.
+        Dict commented_at: {submission id: time.time() of the first reply to it}.
+        Dict requests: {endpoint: number of requests made to it}.
+    """
+
+    def __init__(
+        self, sub="osureport", latency=0, jitter=0, error_rate=0, restricted_rate=0
+    ):
+        self.sub = sub
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.restricted_rate = restricted_rate
+        self.submissions = {}
+        self.comments = {}
+        self.posted_at = {}
+        self.commented_at = {}
+        self.requests = {}
+        # time.time() of every get_user request by id (the sheriff's probes)
+        self.probed_at = []
+        self.next_id = 36**5  # six character base36 ids, like reddit's
+        self.lock = threading.Lock()
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return base36(self.next_id)
+
+    def submit(
+        self,
+        title,
+        selftext="",
+        author="reporter",
+        created_utc=None,
+        link_flair_text=None,
+    ):
+        """
+        Posts a new submission to the subreddit and returns its id.
+        """
+
+        post_id = self.new_id()
+        data = {
+            "id": post_id,
+            "name": "t3_" + post_id,
+            "title": title,
+            "selftext": selftext,
+            "author": author,
+            "subreddit": self.sub,
+            "permalink": "/r/{}/comments/{}/fake/".format(self.sub, post_id),
+            "url": "https://www.reddit.com/r/{}/comments/{}/fake/".format(
+                self.sub, post_id
+            ),
+            "created_utc": created_utc or time.time(),
+            "is_self": True,
+            "link_flair_text": link_flair_text,
+            "link_flair_css_class": None,
+            "removed_by": None,
+            "removed": False,
+            "num_comments": 0,
+        }
+        with self.lock:
+            self.submissions[post_id] = data
+            self.posted_at[post_id] = time.time()
+        return post_id
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def is_restricted(self, user):
+        # stable per user, so every probe for the same user agrees
+        return zlib.crc32(str(user).encode()) % 10000 < self.restricted_rate * 10000
+
+    # Reddit
+    def access_token(self, params):
+        return {
+            "access_token": "fake",
+            "expires_in": 3600,
+            "scope": "*",
+            "token_type": "bearer",
+        }
+
+    def me(self, params):
+        return {"name": "OsuReportBot", "id": "bot"}
+
+    def new(self, params, sub):
+        with self.lock:
+            submissions = list(self.submissions.values())
+        before = params.get("before")
+        if before:
+            names = [submission["name"] for submission in submissions]
+            if before in names:
+                submissions = submissions[names.index(before) + 1 :]
+        limit = int(params.get("limit", 25))
+        newest = submissions[::-1][:limit]
+        return listing([{"kind": "t3", "data": data} for data in newest])
+
+    def submission(self, params, post_id):
+        with self.lock:
+            data = self.submissions.get(post_id)
+        if data is None:
+            return None
+        return [listing([{"kind": "t3", "data": data}]), listing([])]
+
+    def info(self, params):
+        ids = params.get("id", "").split(",")
+        with self.lock:
+            found = [
+                self.submissions[fullname[3:]]
+                for fullname in ids
+                if fullname[3:] in self.submissions
+            ]
+        return listing([{"kind": "t3", "data": data} for data in found])
+
+    def comment(self, params):
+        parent = params["thing_id"]
+        comment_id = self.new_id()
+        data = {
+            "id": comment_id,
+            "name": "t1_" + comment_id,
+            "body": params.get("text", ""),
+            "author": "OsuReportBot",
+            "subreddit": self.sub,
+            "link_id": parent,
+            "parent_id": parent,
+            "created_utc": time.time(),
+            "permalink": "/r/{}/comments/{}/fake/{}/".format(
+                self.sub, parent[3:], comment_id
+            ),
+            "replies": "",
+            "distinguished": None,
+            "stickied": False,
+        }
+        with self.lock:
+            self.comments[comment_id] = data
+            self.commented_at.setdefault(parent[3:], time.time())
+        return {
+            "json": {"errors": [], "data": {"things": [{"kind": "t1", "data": data}]}}
+        }
+
+    def distinguish(self, params, how):
+        with self.lock:
+            data = self.comments.get(params.get("id", "")[3:])
+            if data:
+                data["distinguished"] = "moderator"
+                data["stickied"] = params.get("sticky") == "True"
+        return self.things("t1", data)
+
+    def edit(self, params):
+        with self.lock:
+            data = self.comments.get(params.get("thing_id", "")[3:])
+            if data:
+                data["body"] = params.get("text", "")
+        return self.things("t1", data)
+
+    def flair(self, params, sub):
+        with self.lock:
+            data = self.submissions.get(params.get("link", "")[3:])
+            if data:
+                data["link_flair_text"] = params.get("text")
+                data["link_flair_css_class"] = params.get("css_class")
+        return {"json": {"errors": []}}
+
+    def remove(self, params):
+        with self.lock:
+            data = self.submissions.get(params.get("id", "")[3:])
+            if data:
+                data["removed"] = True
+                data["removed_by"] = "OsuReportBot"
+        return {}
+
+    def things(self, kind, data):
+        things = [{"kind": kind, "data": data}] if data else []
+        return {"json": {"errors": [], "data": {"things": things}}}
+
+    def empty_listing(self, params, *_):
+        return listing([])
+
+    def ok(self, params, *_):
+        return {}
+
+    # osu!
+    def get_user(self, params):
+        user = params.get("u", "")
+        if params.get("type") == "id":
+            with self.lock:
+                self.probed_at.append(time.time())
+        else:
+            user = str(zlib.crc32(user.lower().encode()) % 20000000)
+        if self.is_restricted(user):
+            return []
+        rng = random.Random(user)
+        return [
+            {
+                "user_id": user,
+                "username": params.get("u", ""),
+                "join_date": "2016-0{}-15 01:44:28".format(rng.randint(1, 9)),
+                "pp_raw": "{:.2f}".format(rng.uniform(1000, 15000)),
+                "pp_rank": str(rng.randint(1, 500000)),
+                "total_seconds_played": str(rng.randint(10**5, 10**7)),
+                "playcount": str(rng.randint(1000, 200000)),
+                "country": "US",
+            }
+        ]
+
+    def get_user_best(self, params):
+        rng = random.Random(params.get("u", ""))
+        return [
+            {
+                "beatmap_id": str(rng.randint(1, 4000000)),
+                "enabled_mods": str(rng.choice([0, 8, 16, 24, 64, 72])),
+                "pp": "{:.2f}".format(rng.uniform(100, 900)),
+                "rank": rng.choice(["XH", "SH", "S", "A"]),
+                "date": "2019-06-22 09:11:16",
+                "count50": "0",
+                "count100": str(rng.randint(0, 30)),
+                "count300": str(rng.randint(500, 2000)),
+                "countmiss": str(rng.randint(0, 3)),
+                "countkatu": "0",
+                "countgeki": "0",
+            }
+            for _ in range(10)
+        ]
+
+    def get_scores(self, params):
+        rng = random.Random(params.get("b", "") + params.get("u", ""))
+        return [
+            {
+                "score_id": str(rng.randint(10**9, 4 * 10**9)),
+                "replay_available": rng.choice(["0", "1"]),
+            }
+        ]
+
+    def get_beatmaps(self, params):
+        beatmap_id = params.get("b", "")
+        return [
+            {
+                "beatmap_id": beatmap_id,
+                "title": "Fake Map {}".format(beatmap_id),
+                "approved": "1",
+            }
+        ]
+
+
+# (method, path pattern, FakeState method name, endpoint name for the request counters)
+ROUTES = [
+    ("POST", r"api/v1/access_token", "access_token", "reddit login"),
+    ("GET", r"api/v1/me", "me", "reddit me"),
+    ("GET", r"r/([^/]+)/new", "new", "reddit new"),
+    ("GET", r"comments/([^/]+)(?:/.*)?", "submission", "reddit submission"),
+    ("GET", r"api/info", "info", "reddit info"),
+    ("POST", r"api/comment", "comment", "reddit reply"),
+    ("POST", r"api/distinguish/?([^/]*)", "distinguish", "reddit distinguish"),
+    ("POST", r"api/editusertext", "edit", "reddit edit"),
+    ("POST", r"r/([^/]+)/api/flair", "flair", "reddit flair"),
+    ("POST", r"api/remove", "remove", "reddit remove"),
+    ("POST", r"api/approve", "ok", "reddit approve"),
+    ("POST", r"api/read_message", "ok", "reddit read message"),
+    ("POST", r"api/compose", "ok", "reddit message"),
+    ("GET", r"message/unread", "empty_listing", "reddit inbox"),
+    ("GET", r"r/([^/]+)/about/spam", "empty_listing", "reddit spam queue"),
+    ("GET", r"api/get_user", "get_user", "osu get_user"),
+    ("GET", r"api/get_user_best", "get_user_best", "osu get_user_best"),
+    ("GET", r"api/get_scores", "get_scores", "osu get_scores"),
+    ("GET", r"api/get_beatmaps", "get_beatmaps", "osu get_beatmaps"),
+]
+ROUTES = [
+    (method, re.compile(pattern + "/?$"), name, endpoint)
+    for method, pattern, name, endpoint in ROUTES
+]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Routes requests to the server's FakeState, after the configured latency and error injection.
+    """
+
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real thing
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        state = self.server.state
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            body = self.rfile.read(length).decode()
+            params.update({key: values[-1] for key, values in parse_qs(body).items()})
+        path = url.path.strip("/")
+
+        if method == "POST" and path == "fake/submit":
+            self.respond(
+                200,
+                {
+                    "id": state.submit(
+                        params.get("title", ""), params.get("selftext", "")
+                    )
+                },
+            )
+            return
+
+        for route_method, pattern, name, endpoint in ROUTES:
+            match = pattern.match(path)
+            if route_method != method or not match:
+                continue
+            state.count(endpoint)
+            if state.latency or state.jitter:
+                time.sleep(max(0, random.gauss(state.latency, state.jitter)))
+            if random.random() < state.error_rate:
+                self.respond(500, {"error": "injected failure"})
+                return
+            data = getattr(state, name)(params, *match.groups())
+            if data is None:
+                self.respond(404, {"error": "not found"})
+            else:
+                self.respond(200, data)
+            return
+
+        self.respond(404, {"error": "no fake for {} {}".format(method, path)})
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per request drowns out everything else
+
+
+def serve(state, host="127.0.0.1", port=0):
+    """
+    Starts serving the given FakeState on a background thread. Returns the server; its url is
+    "http://{}:{}".format(*server.server_address).
+    """
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="mean ms to wait on every request"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0, help="standard deviation of the wait, in ms"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="chance for a request to fail"
+    )
+    parser.add_argument(
+        "--restricted-rate",
+        type=float,
+        default=0.1,
+        help="chance for an osu! user to be restricted",
+    )
+    args = parser.parse_args()
+
+    state = FakeState(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        restricted_rate=args.restricted_rate,
+    )
+    server = serve(state, port=args.port)
+    print("Serving on http://{}:{}".format(*server.server_address))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import zlib
+import time
+import queue
+import logging
+import threading
+import contextlib
+from parser import parse_title_data
+from metrics import stage_seconds
+from config import INTAKE_WORKERS, INTAKE_QUEUE_SIZE
+
+# see user_lock
+user_locks = [threading.Lock() for _ in range(64)]
+
+
+def user_lock(user_id):
+    """
+    Returns a lock to hold while checking for and recording a report on the osu! user with the given user_id.
+
+    Intake shards by the username in the title, but the same user can be reported under different names
+    (renames, old names), which can land on different workers. This keeps those reports from both passing
+    the duplicate check. Locks are shared between user_ids, so a report never needs to hold more than one.
+    Returns a no-op context manager if user_id is None.
+    """
+
+    if user_id is None:
+        return contextlib.nullcontext()
+    return user_locks[zlib.crc32(str(user_id).encode()) % len(user_locks)]
+
+
+class Intake:
+    """
+    Hands submissions from the submission stream to a pool of worker threads, so a slow report never stalls the stream.
+
+    Every worker has its own bounded queue. Submissions are sharded by the user they report, so all reports on
+    the same user are processed in order, by the same worker, and duplicate detection sees every earlier report.
+    Reports naming the same user differently are kept apart by user_lock instead.
+    When a worker's queue is full, submit blocks, which stops the stream from reading any further (backpressure).
+
+    Attributes:
+        Function handle: Called with each submission, on a worker thread. Shouldn't raise.
+        List queues: The bounded queue of each worker, holding (submission, time.perf_counter() it was queued at).
+        Set pending: The ids of submissions that are queued or being processed.
+    """
+
+    log = logging.getLogger()
+
+    def __init__(self, handle, workers=INTAKE_WORKERS, size=INTAKE_QUEUE_SIZE):
+        """
+        Initializes an Intake instance. Call start to start its workers.
+
+        Args:
+            Function handle: Called with each submission, on a worker thread.
+            Integer workers: How many worker threads to process submissions on.
+            Integer size: How many submissions each worker's queue can hold.
+        """
+
+        self.handle = handle
+        self.queues = [queue.Queue(maxsize=size) for _ in range(workers)]
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def start(self):
+        for i, work_queue in enumerate(self.queues):
+            threading.Thread(
+                target=self.work,
+                args=[work_queue],
+                name="intake-{}".format(i),
+                daemon=True,
+            ).start()
+        return self
+
+    def shard(self, submission):
+        """
+        Returns the index of the worker that should process the given submission.
+        """
+
+        title_data = parse_title_data(submission.title.lower())
+        # malformatted titles don't name a user, and get rejected without touching anything shared anyway.
+        # osu! treats spaces and underscores in usernames the same
+        key = title_data[1].replace(" ", "_") if title_data else submission.id
+        return zlib.crc32(key.encode()) % len(self.queues)
+
+    def submit(self, submission):
+        """
+        Queues the given submission for its worker, waiting for room if the worker's queue is full.
+
+        Returns False (without queueing it) if the submission is already queued or being processed, True otherwise.
+        """
+
+        with self.lock:
+            if submission.id in self.pending:
+                return False
+            self.pending.add(submission.id)
+        self.queues[self.shard(submission)].put((submission, time.perf_counter()))
+        return True
+
+    def work(self, work_queue):
+        while True:
+            submission, queued_at = work_queue.get()
+            stage_seconds.observe(time.perf_counter() - queued_at, stage="queue_wait")
+            try:
+                self.handle(submission)
+            except Exception as e:
+                Intake.log.critical(
+                    "uncaught error while processing submission {}: {}".format(
+                        submission.id, str(e)
+                    )
+                )
+            finally:
+                with self.lock:
+                    self.pending.discard(submission.id)
+                work_queue.task_done()
+
+    def depths(self):
+        """
+        Returns {(worker index,): submissions in its queue}, for the metrics endpoint.
+        """
+
+        return {
+            (str(i),): work_queue.qsize() for i, work_queue in enumerate(self.queues)
+        }
@@ -0,0 +1,202 @@
+"""
+Drives synthetic reports through the bot end to end, against fake_server.py instead of reddit and the osu! api.
+
+Starts a fake server, runs main.py against it in a scratch directory (with its own db, log, and a fake
+secret.py), posts --reports reports at --rate reports per second, and waits for the bot to reply to all of them.
+Reports throughput and time-to-comment percentiles, plus how long the sheriff took to probe the --records
+old reports seeded into the db before startup.
+
+Usage: python loadtest.py [--reports 200] [--rate 5] [--records 1000] [--latency 50] [--error-rate 0.01]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from fake_server import FakeState, serve
+from config import LIMIT_CHECK
+
+SECRET = """
+ID = "fake"
+SECRET = "fake"
+USERNAME = "OsuReportBot"
+PASSWORD = "fake"
+KEY = "fake"
+"""
+
+OFFENSES = ["relax", "blatant relax", "multi", "aim assist", "timewarp", "spinhack"]
+
+
+def seed_records(directory, state, count):
+    """
+    Adds count old, unrestricted reports to the db in the given directory (and their posts to the fake server),
+    all due for the sheriff to check on startup.
+    """
+
+    # the db lives at a path relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        from db import DB
+
+        db = DB(False)
+        with db.transaction():
+            for i in range(count):
+                created_utc = (
+                    time.time() - random.uniform(0, LIMIT_CHECK) * 24 * 60 * 60
+                )
+                post_id = state.submit(
+                    "[osu!std] seeded{} | cheating".format(i),
+                    created_utc=created_utc,
+                    link_flair_text="10k-0",
+                )
+                db.add_submission(post_id)
+                db.add_user(
+                    post_id,
+                    str(i + 1),
+                    created_utc,
+                    "other",
+                    "false",
+                    "reporter",
+                )
+                # due on the first sweep
+                db.reschedule_user(post_id, created_utc)
+    finally:
+        os.chdir(cwd)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--reports", type=int, default=200, help="reports to post")
+    parser.add_argument(
+        "--rate", type=float, default=5, help="reports to post per second"
+    )
+    parser.add_argument(
+        "--records",
+        type=int,
+        default=0,
+        help="old reports to seed the db with, for the sheriff to check",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=50, help="mean ms the fake server waits"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=20, help="standard deviation of the wait, in ms"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="chance for a request to fail"
+    )
+    parser.add_argument(
+        "--restricted-rate",
+        type=float,
+        default=0.1,
+        help="chance for an osu! user to be restricted",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=600, help="seconds to wait for replies"
+    )
+    args = parser.parse_args()
+
+    state = FakeState(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        restricted_rate=args.restricted_rate,
+    )
+    server = serve(state)
+    url = "http://{}:{}".format(*server.server_address)
+
+    directory = tempfile.mkdtemp(prefix="osu-reporter-loadtest-")
+    with open(os.path.join(directory, "secret.py"), "w") as f:
+        f.write(SECRET)
+    seed_records(directory, state, args.records)
+    seeded = set(state.submissions)
+
+    env = dict(
+        os.environ,
+        PYTHONPATH=directory,
+        OSU_REPORTER_API_BASE=url + "/api/",
+        OSU_REPORTER_REDDIT_URL=url,
+        OSU_REPORTER_OAUTH_URL=url,
+    )
+    print("Running the bot in {} against {}".format(directory, url))
+    started = time.time()
+    bot = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+            "--silent",
+        ],
+        cwd=directory,
+        env=env,
+    )
+
+    posted = []
+    try:
+        start = time.time()
+        for i in range(args.reports):
+            # don't post faster than --rate, but don't fall behind it either
+            time.sleep(max(0, start + i / args.rate - time.time()))
+            posted.append(
+                state.submit(
+                    "[osu!std] player{} | {}".format(
+                        random.randint(0, 10**6), random.choice(OFFENSES)
+                    )
+                )
+            )
+
+        deadline = time.time() + args.timeout
+        while time.time() < deadline and bot.poll() is None:
+            if all(post_id in state.commented_at for post_id in posted):
+                break
+            time.sleep(0.5)
+    finally:
+        bot.terminate()
+        bot.wait()
+
+    replied = [post_id for post_id in posted if post_id in state.commented_at]
+    latencies = [
+        state.commented_at[post_id] - state.posted_at[post_id] for post_id in replied
+    ]
+    print()
+    print("{} of {} reports replied to".format(len(replied), len(posted)))
+    if replied:
+        elapsed = max(state.commented_at[post_id] for post_id in replied) - min(
+            state.posted_at[post_id] for post_id in posted
+        )
+        print("{:.2f} reports/sec".format(len(replied) / elapsed))
+        print(
+            "time to comment: p50 {:.2f}s, p95 {:.2f}s, max {:.2f}s".format(
+                percentile(latencies, 50), percentile(latencies, 95), max(latencies)
+            )
+        )
+    if seeded:
+        resolved = sum(
+            1
+            for post_id in seeded
+            if (state.submissions[post_id]["link_flair_text"] or "") == "Resolved"
+        )
+        print(
+            "sheriff: {} seeded records, {} probes made in {:.2f}s, {} resolved".format(
+                len(seeded),
+                len(state.probed_at),
+                max(state.probed_at, default=started) - started,
+                resolved,
+            )
+        )
+    print()
+    print("requests per endpoint:")
+    for endpoint, count in sorted(state.requests.items()):
+        print("  {:<24} {:>8,}".format(endpoint, count))
+
+
+if __name__ == "__main__":
+    main()
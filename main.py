@@ -1,25 +1,30 @@
+import time
+
+STARTED = time.perf_counter()  # for --startup-time
+
 import argparse
 import logging
-import time
+import contextlib
+import functools
 import threading
-from prawcore.exceptions import RequestException, ServerError, ResponseException
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sys
 import json
-import stats
-import praw
 import secret
 import re
-from db import DB
+from db import DB, connections, SchemaOutdated
 import datetime
-from report import Report
-from sheriff import Sheriff
-from old_report import OldReport
 from config import (
     VERSION,
     SUB,
+    REDDIT_URL,
+    OAUTH_URL,
     LIMIT_DAYS,
     API_USERS,
     CHECK_INTERVAL,
+    STREAM_BACKOFF_MIN,
+    STREAM_BACKOFF_MAX,
+    SHERIFF_WORKERS,
     AUTHOR,
     REJECT_BLACKLISTED,
     REJECT_MALFORMATTED,
@@ -30,7 +35,6 @@ from config import (
     REPLY_RESTRICTED,
 )
 
-
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "-c", "--comment", help="doesn't leave comments on submissions", action="store_true"
@@ -53,6 +57,21 @@ parser.add_argument(
 parser.add_argument(
     "--leadless", help="doesn't modify the database while running", action="store_true"
 )
+parser.add_argument(
+    "--since",
+    help="with --stats, the first day (YYYY-MM-DD, utc) to calculate statistics for. Defaults to a month before --until",
+    type=datetime.date.fromisoformat,
+)
+parser.add_argument(
+    "--until",
+    help="with --stats, the last day (YYYY-MM-DD, utc) to calculate statistics for. Defaults to today",
+    type=datetime.date.fromisoformat,
+)
+parser.add_argument(
+    "--metrics-port",
+    help="serves latency histograms and counters in the prometheus text format at http://127.0.0.1:PORT/metrics",
+    type=int,
+)
 # parser.add_argument("-t", "--test", help="runs test suite and exits", action="store_true")
 
 g1 = parser.add_mutually_exclusive_group()
@@ -61,6 +80,11 @@ g1.add_argument(
     help="calculates and displays statistics from the db",
     action="store_true",
 )
+g1.add_argument(
+    "--startup-time",
+    help="reports how long each phase of starting up (imports, reddit login, worker startup) takes, then exits",
+    action="store_true",
+)
 g1.add_argument(
     "--sweep",
     help="runs through the past 100 submissions and flairs them appropriately, ignoring resolved threads. Sets --comment as well.",
@@ -74,6 +98,16 @@ g2.add_argument("-s", "--silent", help="disables all logging", action="store_tru
 
 args = parser.parse_args()
 
+# --stats exits before anything else runs, so don't silently ignore options it doesn't use
+if not args.stats and (args.since or args.until):
+    parser.error("--since and --until only apply to --stats")
+if args.stats and args.metrics_port is not None:
+    parser.error("--metrics-port can't be used with --stats")
+if args.stats and args.post_id:
+    parser.error("--from-id can't be used with --stats")
+if args.since and args.until and args.since > args.until:
+    parser.error("--since can't be after --until")
+
 # if args.test:
 # 	test_module.run()
 # 	sys.exit()
@@ -119,18 +153,97 @@ if args.silent:
     logging.disable()
 
 
-log.info("Logging into reddit")
-# keep reddit global
-reddit = praw.Reddit(
-    client_id=secret.ID,
-    client_secret=secret.SECRET,
-    user_agent="linux:com.tybug.osureporter:v" + VERSION + " (by /u/tybug2)",
-    username=secret.USERNAME,
-    password=secret.PASSWORD,
+# [(phase, seconds), ...] for --startup-time
+startup_phases = [("core imports", time.perf_counter() - STARTED)]
+
+
+@contextlib.contextmanager
+def startup_phase(name):
+    """
+    Records how long the with block took as the startup phase with the given name.
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        # a phase that failed still took its time, and is likely the one being asked about
+        startup_phases.append((name, time.perf_counter() - start))
+
+
+# --stats only needs sqlite, so skip the heavy imports and reddit login entirely
+if args.stats:
+    import stats
+
+    stats.main(args.since, args.until)
+    sys.exit(0)
+
+# heavy dependencies, only imported once we know we need them
+with startup_phase("import praw"):
+    import praw
+    from prawcore.exceptions import RequestException, ServerError, ResponseException
+with startup_phase("import osu api client"):
+    from osu_api import osu
+with startup_phase("import report handling"):
+    from metrics import registry, timed, serve as serve_metrics
+    from report import Report
+    from sheriff import Sheriff
+    from old_report import OldReport
+    from parser import start_similarity_workers
+    from intake import Intake, user_lock
+
+
+class Reddit(praw.Reddit):
+    """
+    A praw.Reddit that only makes one request at a time.
+
+    praw isn't thread safe, and the intake workers, the sheriff and the similarity callbacks all share one instance.
+    Every request praw makes (including authenticating and waiting on reddit's rate limit) goes through request.
+    """
+
+    lock = threading.Lock()
+
+    def request(self, *args, **kwargs):
+        with Reddit.lock:
+            return praw.Reddit.request(self, *args, **kwargs)
+
+
+# counters for the metrics endpoint, see metrics.py
+reports_processed = registry.counter(
+    "osureporter_reports_total",
+    "Reports processed, by how they were handled",
+    ["outcome"],
+)
+restrictions_found = registry.counter(
+    "osureporter_restrictions_total", "Reported users the sheriff found restricted"
 )
 
-# db interface with a single connection and cursor. Only create this once to limit connections, then pass it to each recorder object (reports and sheriffs)
-DB_MAIN = DB(args.leadless)
+log.info("Logging into reddit")
+with startup_phase("reddit login"):
+    # keep reddit global
+    reddit = Reddit(
+        client_id=secret.ID,
+        client_secret=secret.SECRET,
+        user_agent="linux:com.tybug.osureporter:v" + VERSION + " (by /u/tybug2)",
+        username=secret.USERNAME,
+        password=secret.PASSWORD,
+        reddit_url=REDDIT_URL,
+        oauth_url=OAUTH_URL,
+    )
+    # praw is lazy and only authenticates on the first request, so make one to time the login itself
+    if args.startup_time:
+        reddit.user.me()
+
+with startup_phase("open db"):
+    # db interface, passed to each recorder object (reports and sheriffs). Connections are per thread
+    # (see db#ConnectionManager), so the stream and sheriff threads can safely share this
+    DB_MAIN = DB(args.leadless)
+    # --leadless never migrates (or otherwise touches) the database, see db#ConnectionManager
+    connections.leadless = args.leadless
+    try:
+        DB_MAIN.load_submissions()
+    except SchemaOutdated as e:
+        sys.exit(str(e))
 
 log.info("Login successful")
 
@@ -143,12 +256,12 @@ log.info("Login successful")
 
 def main():
 
-    if args.sweep:
-        sweep()
+    if args.startup_time:
+        report_startup_time()
         sys.exit(0)
 
-    if args.stats:
-        stats.main()
+    if args.sweep:
+        sweep()
         sys.exit(0)
 
     if args.post_id:
@@ -160,66 +273,63 @@ def main():
         )
         sys.exit(0)
 
-    try:
-        check_banned(
-            not args.comment, not args.flair
-        )  # repeats on CHECK_INTERVAL minutes interval
-    except KeyboardInterrupt:
-        log.info("Received SIGINT, terminating")
-        sys.exit(0)
+    # workers are forked, so start them before we have any other threads
+    start_similarity_workers()
+
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+        log.info(
+            "Serving metrics at http://127.0.0.1:{}/metrics".format(args.metrics_port)
+        )
+
+    # checks on a CHECK_INTERVAL minutes interval. Dies when the main thread dies
+    threading.Thread(
+        target=patrol,
+        args=[not args.comment, not args.flair],
+        name="sheriff",
+        daemon=True,
+    ).start()
+
+    # reports are processed on the intake workers, this thread only reads the submission stream
+    intake = Intake(
+        functools.partial(
+            handle_submission,
+            shouldComment=not args.comment,
+            shouldFlair=not args.flair,
+        )
+    ).start()
+    registry.gauge(
+        "osureporter_intake_queue_depth",
+        "Submissions waiting in each intake worker's queue",
+        ["worker"],
+        collect=intake.depths,
+    )
 
     # Iterate over every new submission forever
+    backoff = STREAM_BACKOFF_MIN
     while True:
 
         subreddit = reddit.subreddit(SUB)
         submission_stream = subreddit.stream.submissions()
-        # two layers of exception handling, one for the processing and one for the submission stream
         try:
             for submission in submission_stream:
-                try:
-                    # Already processed; praw returns the past 100 results for streams, previously iterated over or not
-                    if DB_MAIN.submission_exists(submission.id):
-                        log.debug(
-                            "Submission {} is already processed".format(submission.id)
-                        )
-                        continue
-                    process_submission(submission, not args.comment, not args.flair)
-                except RequestException as e:
-                    log.warning(
-                        "Request exception while processing submission {}: {}. Waiting 10 seconds".format(
-                            submission.id, str(e)
-                        )
-                    )
-                    time.sleep(10)
-                except ServerError as e:
-                    log.warning(
-                        "Server error while processing submission {}: {}. Reddit likely under heavy load".format(
-                            submission.id, str(e)
-                        )
-                    )
-                except json.decoder.JSONDecodeError as e:
-                    log.warning(
-                        "JSONDecode exception while processing submission {}: {}.".format(
-                            submission.id, str(e)
-                        )
-                    )
-                except Exception as e:
-                    log.critical(
-                        "some other error while processing submission {}: {}".format(
-                            submission.id, str(e)
-                        )
+                # the stream is healthy again, so the next failure starts backing off from the start
+                backoff = STREAM_BACKOFF_MIN
+                # Already processed; praw returns the past 100 results for streams, previously iterated over or not
+                if DB_MAIN.submission_exists(submission.id):
+                    log.debug(
+                        "Submission {} is already processed".format(submission.id)
                     )
+                    continue
+                # blocks while the worker for this submission is too far behind
+                if not intake.submit(submission):
+                    log.debug("Submission {} is already queued".format(submission.id))
 
         except KeyboardInterrupt:
             log.info("Received SIGINT, terminating")
             sys.exit(0)
         except RequestException as e:
-            log.warning(
-                "Request exception in submission stream: {}. Waiting 10 seconds".format(
-                    str(e)
-                )
-            )
-            time.sleep(10)
+            log.warning("Request exception in submission stream: {}.".format(str(e)))
         except ServerError as e:
             log.warning("Server error in submission stream: {}.".format(str(e)))
         except json.decoder.JSONDecodeError as e:
@@ -227,8 +337,61 @@ def main():
         except Exception as e:
             log.critical("some other error in submission stream: {}".format(str(e)))
 
-        # sleep for two minutes, give any connection issues some time to resolve itself
-        time.sleep(60 * 2)
+        # give any connection issues some time to resolve themselves, waiting longer every time in a row it fails
+        log.info("Restarting the submission stream in {} seconds".format(backoff))
+        time.sleep(backoff)
+        backoff = min(backoff * 2, STREAM_BACKOFF_MAX)
+
+
+def handle_submission(submission, shouldComment, shouldFlair):
+    """
+    Processes the given submission (see process_submission), logging instead of raising if anything goes wrong.
+    Runs on the intake workers.
+    """
+
+    try:
+        process_submission(submission, shouldComment, shouldFlair)
+    except RequestException as e:
+        # no waiting here, that would hold up every submission queued behind this one. The stream backs off by itself
+        log.warning(
+            "Request exception while processing submission {}: {}.".format(
+                submission.id, str(e)
+            )
+        )
+    except ServerError as e:
+        log.warning(
+            "Server error while processing submission {}: {}. Reddit likely under heavy load".format(
+                submission.id, str(e)
+            )
+        )
+    except json.decoder.JSONDecodeError as e:
+        log.warning(
+            "JSONDecode exception while processing submission {}: {}.".format(
+                submission.id, str(e)
+            )
+        )
+    except Exception as e:
+        log.critical(
+            "some other error while processing submission {}: {}".format(
+                submission.id, str(e)
+            )
+        )
+
+
+def report_startup_time():
+    """
+    Prints how long each startup phase took, including the ones only normally paid for later, on first use.
+    """
+
+    with startup_phase("import circleguard (first similarity check)"):
+        import circleguard
+    with startup_phase("start similarity workers"):
+        start_similarity_workers(wait=True)
+
+    total = time.perf_counter() - STARTED
+    for phase, seconds in startup_phases:
+        print("{:<45} {:>8.0f}ms".format(phase, seconds * 1000))
+    print("{:<45} {:>8.0f}ms".format("total", total * 1000))
 
 
 def process_submission(submission, shouldComment, shouldFlair):
@@ -236,18 +399,50 @@ def process_submission(submission, shouldComment, shouldFlair):
     Processes the given reddit submission.
     """
 
+    with timed("process_submission"):
+        outcome = process_report(submission, shouldComment, shouldFlair)
+    reports_processed.inc(outcome=outcome)
+
+
+def process_report(submission, shouldComment, shouldFlair):
+    """
+    Does the actual processing for process_submission. Returns how the report was handled, one of
+    "blacklisted", "malformatted", "restricted", "duplicate" or "replied".
+    """
+
     report = Report(submission, shouldComment, shouldFlair, DB_MAIN)
-    report.mark_read()
+    # from the duplicate check until the report is recorded, see intake#user_lock
+    with user_lock(getattr(report, "user_id", None)):
+        try:
+            return act_on_report(report)
+        except Exception:
+            # if our reply is already up, mark the submission read anyway so it's never replied to twice.
+            # Otherwise write nothing, so it's processed again
+            if report.comment is None:
+                report.writes = []
+            else:
+                report.mark_read()
+            raise
+        finally:
+            # every db write for this submission is made at once, only after we're done talking to reddit
+            report.record()
+
+
+def act_on_report(report):
+    """
+    Replies to, flairs and rejects the report as needed, queueing its db writes for Report#record.
+    Returns how the report was handled, see process_report.
+    """
 
     # for discssion threads etc
     if report.has_blacklisted_words():
         report.reject(REJECT_BLACKLISTED)
-        return
+        return "blacklisted"
 
     # title wasn't properly formatted
     if report.check_malformatted():
         report.reply(REPLY_MALFORMATTED).reject(REJECT_MALFORMATTED, remove=True)
-        return
+        return "malformatted"
 
     # flair it based on what was in the title
     report.flair()
@@ -257,16 +452,20 @@ def process_submission(submission, shouldComment, shouldFlair):
         report.reply(REPLY_RESTRICTED.format(API_USERS + report.username)).reject(
             REJECT_RESTRICTED, remove=True
         )
-        return
+        return "restricted"
 
-    previous_links = report.generate_previous_links()
+    with timed("previous_links"):
+        previous_links = report.generate_previous_links()
 
-    previous_id = report.check_duplicate()  # returns post id from db query
+    # returns post id from the user's history
+    with timed("check_duplicate"):
+        previous_id = report.check_duplicate()
 
     # If the previous submission says removed, the author likely deleted it and no one gains anything by the bot
-    # linking back there. We still want to preserve any potential history in the thread so we don't modify its
+    # linking back there, so check_duplicate ignores those (the sheriff marks them, see Sheriff#refresh_deleted).
+    # We still want to preserve any potential history in the thread so we don't modify its
     # database entry so we can still link to it in "all previous reports: "
-    if previous_id and reddit.submission(id=previous_id).selftext != "[deleted]":
+    if previous_id:
         log.debug(
             "User reported in post {} was already reported in the past {} days in post {}".format(
                 report.post_id, LIMIT_DAYS, previous_id
@@ -280,91 +479,150 @@ def process_submission(submission, shouldComment, shouldFlair):
                 LIMIT_DAYS,
             )
         ).reject(REJECT_REPORTED)
-        return
+        return "duplicate"
 
     # all special cases handled, finally reply with the data and add to db for sheriff to check
-    report.reply_data_and_mark()
+    report.reply_data_and_mark().mark_read()
+    return "replied"
+
 
+def patrol(shouldComment, shouldFlair):
+    """
+    Calls check_banned every CHECK_INTERVAL minutes, forever.
 
-checked_times = 0
+    Runs on a single long-lived thread so the sheriff keeps reusing that thread's db connection
+    instead of reconnecting every interval, and so a slow check can never overlap with the next one.
+    """
 
+    while True:
+        start = time.time()
+        with timed("check_banned"):
+            check_banned(shouldComment, shouldFlair, start)
+        time.sleep(max(0, CHECK_INTERVAL * 60 - (time.time() - start)))
 
-def check_banned(shouldComment, shouldFlair):
-    thread = threading.Timer(
-        CHECK_INTERVAL * 60, check_banned, [shouldComment, shouldFlair]
-    )
-    thread.daemon = True  # Dies when the main thread dies
-    thread.start()
-    global checked_times
-    checked_times += 1
+
+def check_banned(shouldComment, shouldFlair, started):
+    """
+    Checks the reports due for a restriction check, then forwards the bot's mail.
+    started is the unix timestamp the sweep started at, which next checks are scheduled from.
+    """
 
     try:
-        # make a new one for every thread so we don't get two threads modifying at the same time
-        # generating a new connection every CHECK_INTERVAL minutes isn't terribly expensive
-        DB_CHECK = DB(args.leadless)
-        sheriff = Sheriff(DB_CHECK)
-
-        records = sheriff.get_records()
-
-        # check all recentish records instead
-        # occurs roughly once a day with a check interval of 15 minutes
-        if checked_times % 100 == 0:
-            records = sheriff.get_recentish_records()
-            log.debug("checking recentish records")
-
-        log.debug("")
-        log.debug("Checking " + str(len(records)) + " posts for restrictions")
-        for record in records:  # only retrieves records in the past month
-            post_id = record[0]
-            log.debug("Checking post {}".format(post_id))
-            submission = reddit.submission(id=post_id)
-            report = OldReport(submission, shouldComment, shouldFlair, record, DB_CHECK)
-
-            if report.check_restricted():
-                # resolve the original post (the one we checked)
-                log.info("resolving post {}".format(report.post_id))
-                report.resolve()
-                # resolve all previous reports on the same guy, regardless of time limit
-                for _record in report.get_user_records():
-                    _report = OldReport(
-                        reddit.submission(id=_record[0]),
-                        shouldComment,
-                        shouldFlair,
-                        _record,
-                        DB_CHECK,
+        with timed("sweep"):
+            sheriff = Sheriff(DB_MAIN)
+
+            # only the records whose next check is due, see utils#next_check
+            records = sheriff.get_records()
+
+            log.debug("")
+            users = sheriff.group_records(records)
+            log.debug(
+                "Checking {} posts on {} users for restrictions".format(
+                    len(records), len(users)
+                )
+            )
+            reports = []
+            for user_id, user_records in users.items():
+                # every post on the same user shares the same verdict, so only probe
+                # the api once per user and fan the result out to all of their posts
+                log.debug(
+                    "Checking user {} (posts {})".format(
+                        user_id, ", ".join(record[0] for record in user_records)
                     )
-                    _report.resolve()
+                )
+                record = user_records[0]
+                submission = reddit.submission(id=record[0])
+                reports.append(
+                    OldReport(submission, shouldComment, shouldFlair, record, DB_MAIN)
+                )
+
+            # probes only talk to the osu api, so run them on the pool. Resolving touches reddit
+            # and the db, so that stays on this thread
+            with ThreadPoolExecutor(max_workers=SHERIFF_WORKERS) as executor:
+                futures = {
+                    executor.submit(report.check_restricted): report
+                    for report in reports
+                }
+                for future in as_completed(futures):
+                    report = futures[future]
+                    if not future.result():
+                        # still unrestricted, check again later
+                        sheriff.reschedule(
+                            users[report.user_id],
+                            len(report.get_user_records()),
+                            started,
+                        )
+                        continue
+                    restrictions_found.inc()
+                    # resolve all reports on the same guy, regardless of time limit
+                    restricted_utc = time.time()
+                    _reports = [
+                        OldReport(
+                            reddit.submission(id=_record[0]),
+                            shouldComment,
+                            shouldFlair,
+                            _record,
+                            DB_MAIN,
+                        )
+                        for _record in report.get_user_records()
+                    ]
+                    for _report in _reports:
+                        log.info("resolving post {}".format(_report.post_id))
+                        try:
+                            _report.resolve()
+                        except Exception as e:
+                            # the restriction still gets recorded, so it isn't flaired again next sweep
+                            log.warning(
+                                "Couldn't flair post {} resolved: {}".format(
+                                    _report.post_id, str(e)
+                                )
+                            )
+                    # flairing talks to reddit, so only start writing (and take the db's write lock) once that's done
+                    with DB_MAIN.transaction():
+                        for _report in _reports:
+                            _report.mark_restricted(restricted_utc)
+
+        log.debug("Done. Checking for deleted reports")
+        with timed("refresh_deleted"):
+            deleted = sheriff.refresh_deleted(reddit)
+        if deleted:
+            log.info("marked deleted posts {}".format(", ".join(deleted)))
 
         log.debug("Done. Checking mail")
         # Might as well forward pms here...already have an automated function, why not?
-        for message in reddit.inbox.unread():
-            isComment = isinstance(message, praw.models.Comment)
-            type_ = "reply" if isComment else "PM"
-            if message.author == AUTHOR:
-                log.debug("Not forwarding {} by AUTHOR ({})".format(type_, AUTHOR))
-                return
-
-            log.info("Forwarding {} by {} to {}".format(type_, message.author, AUTHOR))
-
-            reddit.redditor(AUTHOR).message(
-                "Forwarding {} from u/{}".format(type_, message.author),
-                (
-                    "["
-                    + message.body
-                    + "]({})".format("https://reddit.com" + message.context)
-                    if isComment
-                    else message.body
-                ),
-            )
-            message.mark_read()
+        with timed("inbox"):
+            for message in reddit.inbox.unread():
+                isComment = isinstance(message, praw.models.Comment)
+                type_ = "reply" if isComment else "PM"
+                if message.author == AUTHOR:
+                    log.debug("Not forwarding {} by AUTHOR ({})".format(type_, AUTHOR))
+                    return
+
+                log.info(
+                    "Forwarding {} by {} to {}".format(type_, message.author, AUTHOR)
+                )
+
+                reddit.redditor(AUTHOR).message(
+                    "Forwarding {} from u/{}".format(type_, message.author),
+                    (
+                        "["
+                        + message.body
+                        + "]({})".format("https://reddit.com" + message.context)
+                        if isComment
+                        else message.body
+                    ),
+                )
+                message.mark_read()
 
         log.debug("Done. Checking spam-removed reports")
-        for submission in reddit.subreddit("mod").mod.spam(only="submissions"):
-            if submission.removed_by is None:
-                log.info(f"approving spam-removed submission {submission}")
-                submission.mod.approve()
+        with timed("spam_queue"):
+            for submission in reddit.subreddit("mod").mod.spam(only="submissions"):
+                if submission.removed_by is None:
+                    log.info(f"approving spam-removed submission {submission}")
+                    submission.mod.approve()
 
         log.debug("..done")
+        log.debug("osu api latency so far:\n" + osu.latency_summary())
 
     except RequestException as e:
         log.warning("Request exception while checking old reports: {}".format(str(e)))
@@ -0,0 +1,246 @@
+"""
+Latency histograms and counters for the stages of processing a report and checking old ones, so slow replies can be
+traced back to reddit, the osu! api, circleguard or sqlite.
+
+Everything registered in registry can be scraped in the prometheus text format from a local http endpoint,
+see serve (and --metrics-port).
+"""
+
+import time
+import bisect
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import METRICS_BUCKETS
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in pairs
+        )
+        + "}"
+    )
+
+
+class Metric:
+    """
+    A named family of values, one per combination of label values.
+
+    Attributes:
+        String name: The name the metric is exposed under.
+        String help: What the metric measures.
+        List labels: The names of the metric's labels.
+        Dict values: {tuple of label values: value}.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = list(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        """
+        Returns the metric in the prometheus text format, as a list of lines.
+        """
+
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines += self.render_value(key, value)
+        return lines
+
+    def render_value(self, key, value):
+        return [
+            "{}{} {}".format(self.name, format_labels(self.labels, key), float(value))
+        ]
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, like the number of requests made.
+    """
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, like the number of requests waiting.
+
+    If collect is passed, it's called on every scrape and returns the current {tuple of label values: value},
+    so the value is read from wherever it's already kept instead of being mirrored here.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        Metric.__init__(self, name, help, labels)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def render(self):
+        if self.collect:
+            values = self.collect()
+            with self.lock:
+                self.values = dict(values)
+        return Metric.render(self)
+
+
+class Histogram(Metric):
+    """
+    Counts observed values (eg seconds a stage took) into buckets, so percentiles can be estimated from them.
+
+    Values are stored as [count per bucket (the last one catching everything above the largest bucket), sum].
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], counts):
+            cumulative += count
+            lines.append(
+                "{}_bucket{} {}".format(
+                    self.name,
+                    format_labels(self.labels, key, [("le", bound)]),
+                    cumulative,
+                )
+            )
+        lines.append(
+            "{}_sum{} {}".format(self.name, format_labels(self.labels, key), total)
+        )
+        lines.append(
+            "{}_count{} {}".format(
+                self.name, format_labels(self.labels, key), cumulative
+            )
+        )
+        return lines
+
+
+class Registry:
+    """
+    Every metric exposed by the metrics endpoint.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), collect=None):
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """
+        Returns every metric in the prometheus text format.
+        """
+
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    "osureporter_stage_seconds",
+    "Seconds taken by each stage of processing a report or checking old ones",
+    ["stage"],
+)
+stage_errors = registry.counter(
+    "osureporter_stage_errors_total",
+    "Stages that raised instead of finishing",
+    ["stage"],
+)
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """
+    Records how long the with block took in stage_seconds, and counts it in stage_errors if it raised.
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # a line per scrape would drown out the action log
+
+
+def serve(port, host="127.0.0.1"):
+    """
+    Serves the registry's metrics at http://host:port/metrics from a background thread. Returns the server.
+    Only listens locally by default; put a reverse proxy in front of it to scrape from elsewhere.
+    """
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
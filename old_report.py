@@ -1,13 +1,8 @@
 from reddit_bound import RedditBound
-from parser import parse_user_data
+from parser import probe_user
 import logging
 from recorder import Recorder
-import time
-
-
-import requests
-from config import API_BASE
-from secret import KEY
+from config import USER_RESTRICTED
 
 
 class OldReport(Recorder, RedditBound):
@@ -38,7 +33,7 @@ class OldReport(Recorder, RedditBound):
             Submission submission: The reddit submission to check.
             Boolean shouldComment: Whether comments should be left on the submission.
             Boolean shouldFlair: Whether the flair of the submission should be modified.
-            List record: The list returned by db#get_recent_users.
+            List record: The list returned by db#get_due_users.
             DB DB: The database interface and connection for this class.
         """
 
@@ -57,36 +52,12 @@ class OldReport(Recorder, RedditBound):
         """
         Checks if the user reported in the submission is restricted.
 
-        Attempts to retrive the user's information through the api.
-        If the api returns an empty response or throws an error, returns True, else returns False.
+        Probes the api for the user (see parser#probe_user).
+        Returns True if the api returned an empty response, False if the user exists or the request failed.
         """
 
-        user_data = None
-        try:
-            user_data = parse_user_data(
-                self.user_id, "0", "id"
-            )  # gamemode doesn't matter here since we're just
-            # checking for empty response
-        except Exception as e:
-            log = requests.get(
-                API_BASE
-                + "get_user?k="
-                + KEY
-                + "&u="
-                + self.user_id
-                + "&m="
-                + "0"
-                + "&type="
-                + "id"
-            ).json()
-            OldReport.log.warning(
-                "Exception while parsing user data for user {}: {}. Log: {}".format(
-                    self.user_id, str(e), log
-                )
-            )
-            return False
-
-        return True if not user_data else False
+        # gamemode doesn't matter here since we're just checking for an empty response
+        return probe_user(self.user_id, "0", "id") == USER_RESTRICTED
 
     def get_user_records(self):
         """
@@ -99,7 +70,7 @@ class OldReport(Recorder, RedditBound):
 
     def resolve(self):
         """
-        Flairs the submission resolved and marks its database entry as restricted
+        Flairs the submission resolved. See mark_restricted for the database side.
         """
 
         if self.shouldFlair:
@@ -108,5 +79,10 @@ class OldReport(Recorder, RedditBound):
             flair = self.submission.link_flair_text + "-resolved"
             self.submission.mod.flair("Resolved", flair)
 
-        self.DB.restrict_user(self.post_id, time.time())
+    def mark_restricted(self, restricted_utc):
+        """
+        Marks the submission's database entry as restricted at the given unix timestamp.
+        """
+
+        self.DB.restrict_user(self.post_id, restricted_utc)
         self.DB.restrict_submission(self.post_id)
@@ -0,0 +1,264 @@
+import time
+import threading
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from secret import KEY
+from metrics import registry
+from config import (
+    API_BASE,
+    API_TIMEOUT,
+    API_MAX_IN_FLIGHT,
+    API_LOW_IN_FLIGHT,
+    API_RATE_LIMIT,
+    API_BURST,
+)
+
+# request priorities. New reports are waiting on a reply, so their requests always go before
+# the sheriff's background probes
+HIGH = "high"
+LOW = "low"
+
+api_seconds = registry.histogram(
+    "osureporter_osu_api_seconds",
+    "Seconds taken by osu api requests, excluding time spent waiting on the rate limiter",
+    ["endpoint"],
+)
+api_errors = registry.counter(
+    "osureporter_osu_api_errors_total",
+    "osu api requests that failed or timed out",
+    ["endpoint"],
+)
+limiter_wait_seconds = registry.histogram(
+    "osureporter_osu_api_limiter_wait_seconds",
+    "Seconds osu api requests waited on the rate limiter for a token",
+    ["priority"],
+)
+
+
+class RateLimiter:
+    """
+    Token bucket that keeps every thread's osu api requests, together, under API_RATE_LIMIT per minute.
+
+    Each request takes a token; tokens refill continuously at rate per second, up to burst. Requests
+    that find the bucket empty wait in their priority's lane, and low priority requests additionally
+    wait while any high priority request is waiting, so a large sweep can never delay a reply.
+
+    Attributes:
+        Float rate: Tokens added per second.
+        Integer burst: Max tokens the bucket can hold.
+        Float tokens: Tokens currently in the bucket.
+        Dict waiting: {priority: number of requests currently waiting for a token}.
+        Dict waits: {priority: [requests, total seconds waited, max seconds waited]}.
+    """
+
+    def __init__(self, per_minute, burst):
+        """
+        Initializes a full RateLimiter.
+
+        Args:
+            Integer per_minute: Requests allowed per minute.
+            Integer burst: Requests allowed at once.
+        """
+
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+        self.waiting = {HIGH: 0, LOW: 0}
+        self.waits = {HIGH: [0, 0.0, 0.0], LOW: [0, 0.0, 0.0]}
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority):
+        """
+        Blocks until a token is available for a request of the given priority, then takes it.
+        """
+
+        start = time.monotonic()
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    self.refill()
+                    yielding = priority == LOW and self.waiting[HIGH]
+                    if self.tokens >= 1 and not yielding:
+                        self.tokens -= 1
+                        break
+                    # sleep until the next token is due; whoever takes it wakes the rest of us to recheck
+                    self.condition.wait(max(1 - self.tokens, 0.1) / self.rate)
+            finally:
+                self.waiting[priority] -= 1
+            self.condition.notify_all()
+
+            waited = time.monotonic() - start
+            limiter_wait_seconds.observe(waited, priority=priority)
+            counters = self.waits[priority]
+            counters[0] += 1
+            counters[1] += waited
+            counters[2] = max(counters[2], waited)
+
+    def drain(self):
+        """
+        Empties the bucket, for when the api tells us we're going too fast anyway.
+        """
+
+        with self.condition:
+            self.refill()
+            self.tokens = min(self.tokens, 0)
+
+    def summary(self):
+        """
+        Returns a human readable summary of the queue depth and wait times, one priority per line.
+        """
+
+        with self.condition:
+            return "\n".join(
+                "{} priority: {} waiting, {} requests, {:.0f}ms avg wait, {:.0f}ms max wait".format(
+                    priority,
+                    self.waiting[priority],
+                    count,
+                    total / count * 1000 if count else 0,
+                    worst * 1000,
+                )
+                for priority, (count, total, worst) in self.waits.items()
+            )
+
+
+class OsuAPI:
+    """
+    Client for the osu! api (v1), shared by every thread that talks to the api.
+
+    Requests go through a single pooled session, so connections are kept alive and reused instead of
+    paying a new tcp + tls handshake for every request.
+
+    Attributes:
+        String key: The api key to authenticate with.
+        Session session: The pooled http session requests are made on.
+        BoundedSemaphore slots: Caps the number of requests in flight at once, across all threads,
+                                so a large sheriff sweep can't flood the api.
+        BoundedSemaphore low_slots: Caps the number of low priority requests in flight, so they can never take up
+                                    every slot and make high priority requests wait behind them.
+        RateLimiter limiter: Caps the number of requests per minute, across all threads.
+        Dict latency: {endpoint: [requests, errors, total seconds, max seconds]} for every endpoint requested so far.
+    """
+
+    log = logging.getLogger()
+
+    def __init__(self, key):
+        """
+        Initializes an OsuAPI instance.
+
+        Args:
+            String key: The api key to authenticate with.
+        """
+
+        self.key = key
+        self.session = requests.Session()
+        # one pooled connection per request we allow in flight, so no request ever waits on a connection
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_MAX_IN_FLIGHT)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.slots = threading.BoundedSemaphore(API_MAX_IN_FLIGHT)
+        self.low_slots = threading.BoundedSemaphore(API_LOW_IN_FLIGHT)
+        self.limiter = RateLimiter(API_RATE_LIMIT, API_BURST)
+        self.latency = {}
+        self.lock = threading.Lock()
+
+    def request(self, endpoint, priority=HIGH, **params):
+        """
+        Requests the given endpoint with the given query parameters and returns the decoded json response.
+
+        Waits on the rate limiter in the given priority's lane, then for a free slot if API_MAX_IN_FLIGHT
+        requests (or API_LOW_IN_FLIGHT low priority ones) are already in flight.
+        Raises if the request fails or times out (see API_TIMEOUT), or if the response isn't json.
+        """
+
+        params["k"] = self.key
+        self.limiter.acquire(priority)
+        if priority == LOW:
+            with self.low_slots:
+                return self.send(endpoint, params)
+        return self.send(endpoint, params)
+
+    def send(self, endpoint, params):
+        """
+        Sends the request for request, once it's allowed to.
+        """
+
+        with self.slots:
+            start = time.perf_counter()
+            failed = True
+            try:
+                response = self.session.get(
+                    API_BASE + endpoint, params=params, timeout=API_TIMEOUT
+                )
+                if response.status_code == 429:
+                    self.limiter.drain()
+                response.raise_for_status()
+                data = response.json()
+                failed = False
+                return data
+            finally:
+                self.record(endpoint, time.perf_counter() - start, failed)
+
+    def record(self, endpoint, seconds, failed):
+        """
+        Adds a request to the given endpoint that took the given amount of seconds to the latency counters.
+        """
+
+        api_seconds.observe(seconds, endpoint=endpoint)
+        if failed:
+            api_errors.inc(endpoint=endpoint)
+        with self.lock:
+            counters = self.latency.setdefault(endpoint, [0, 0, 0.0, 0.0])
+            counters[0] += 1
+            counters[1] += 1 if failed else 0
+            counters[2] += seconds
+            counters[3] = max(counters[3], seconds)
+
+    def latency_summary(self):
+        """
+        Returns a human readable summary of the latency counters, one endpoint per line,
+        followed by the rate limiter's summary.
+        """
+
+        with self.lock:
+            lines = [
+                "{}: {} requests, {} errors, {:.0f}ms avg, {:.0f}ms max".format(
+                    endpoint, count, errors, total / count * 1000, worst * 1000
+                )
+                for endpoint, (count, errors, total, worst) in self.latency.items()
+            ]
+        return "\n".join(lines + [self.limiter.summary()])
+
+    def get_user(self, user, mode, type, priority=HIGH):
+        return self.request("get_user", priority, u=user, m=mode, type=type)
+
+    def get_user_best(self, user, mode, type, priority=HIGH):
+        return self.request("get_user_best", priority, u=user, m=mode, type=type)
+
+    def get_scores(self, beatmap_id, user, mode, mods, priority=HIGH):
+        return self.request(
+            "get_scores", priority, b=beatmap_id, u=user, m=mode, mods=mods
+        )
+
+    def get_beatmaps(self, beatmap_id, priority=HIGH):
+        return self.request("get_beatmaps", priority, b=beatmap_id)
+
+
+# one client (and one connection pool) for the whole process
+osu = OsuAPI(KEY)
+
+registry.gauge(
+    "osureporter_osu_api_queue_depth",
+    "osu api requests currently waiting on the rate limiter for a token",
+    ["priority"],
+    collect=lambda: {
+        (priority,): waiting for priority, waiting in osu.limiter.waiting.items()
+    },
+)
@@ -1,28 +1,56 @@
 import re
-import requests
 from secret import KEY
 import logging as log
 from datetime import datetime
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from config import (
     GAMEMODES,
     FLAIRS,
     OFFENSES,
     BLATANT,
     TITLE_MATCH,
-    API_BASE,
     API_USERS,
     REPLY_FOOTER,
     LIMIT_TOP_PLAYS,
+    BEATMAP_CACHE_SIZE,
+    BEATMAP_IMMUTABLE,
+    REPLY_WORKERS,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    USER_EXISTS,
+    USER_RESTRICTED,
+    USER_ERROR,
+    SIMILARITY_WORKERS,
+    SIMILARITY_DEADLINE,
+    REPLAY_CACHE_PATH,
+    REPLAY_CACHE_SIZE,
 )
 from utils import calc_acc, calc_mods, parse_play_rank
-
-from circleguard import Circleguard, ReplayID
+from osu_api import osu, LOW
+from cache import LRUCache, TTLCache, ReplayCache
 
 # yes yes, globals bad, I know. The rest of this codebase is already crappy
 # though so what's the harm in making it a little worse.
-# TODO cache? reports are pretty infrequent though, probably not necessary,
-# though they do get repeated sometimes.
-cg = Circleguard(KEY)
+# Only set in similarity worker processes, see init_similarity_worker
+cg = None
+replay_cache = None
+
+# replay similarity downloads two replays and is cpu heavy, so it runs in separate processes instead
+# of blocking whichever thread is processing the submission. See submit_similarity
+similarity_executor = None
+similarity_lock = threading.Lock()
+
+# sits in front of the BEATMAPS table, see parse_map_data
+beatmap_cache = LRUCache(BEATMAP_CACHE_SIZE)
+
+# popular users tend to get reported several times in a short window, see parse_user_data
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# for the per-play api lookups in create_reply
+reply_executor = ThreadPoolExecutor(max_workers=REPLY_WORKERS)
 
 
 def parse_title_data(title):
@@ -39,10 +67,10 @@ def parse_title_data(title):
     player = parts[
         0
     ].strip()  # take from gamemode to first pipe, remove leading + trailing spaces
-    offense = parts[-1].strip()  # the last occurence. Identical to info[1] usually,
-    # but when there's no more pipes (ie title is "[osu!std] tybug") info[1] will throw IOOB
-    offense_data = parse_offense_data(offense)
-    flair_data = parse_flair_data(title)
+    # the offense is everything after the first pipe. When there's no pipe (ie title is "[osu!std] tybug"),
+    # it's the same as the player
+    offense_start = title_data.start(2) + (len(parts[0]) + 1 if len(parts) > 1 else 0)
+    offense_data, flair_data = classify_title(title, offense_start, title_data.end(2))
     return [gamemode, player, offense_data, flair_data]
 
 
@@ -66,17 +94,7 @@ def parse_flair_data(title):
     or Cheating if no match could be found
     """
 
-    # Match on all words; if the title was something like
-    # "[osu!std] rttyu-i | Account Sharing/Multi [ Discussion ]" it would
-    # check "account", "sharing", "multi", "[", "discussion", "]"
-    title = re.split("[|\s/]+", title)
-    for flair in FLAIRS:
-        if [
-            i for i in title if i in FLAIRS[flair]
-        ]:  # SO magic, checks if any item in L1 is also in L2
-            return [FLAIRS[flair][-1], flair]
-
-    return ["Cheating", "cheating"]
+    return classify_title(title, len(title), len(title))[1]
 
 
 def parse_offense_data(offense):
@@ -85,91 +103,183 @@ def parse_offense_data(offense):
     Returns a list containing [offense_name, blatant?]
     (whether the title contained anything in BLATANT)
     """
-    offense = re.split("[|\s/]+", offense)
-    log.debug("offense split: %s", offense)
-    data = ["other"]
-    for offense_type in OFFENSES:
-        if [i for i in offense if i in OFFENSES[offense_type]]:
-            data[0] = offense_type
-            break
-
-    # if any element of offense is in blatant
-    if [i for i in offense if i in BLATANT]:
-        data.append("true")
+
+    return classify_title(offense, 0, len(offense))[0]
+
+
+def build_keyword_index():
+    """
+    Returns a dict of {token: [flair priority, offense priority, blatant?]} for every token in FLAIRS, OFFENSES and BLATANT.
+    A priority is the position of the flair or offense in its table (lower wins), or None if the token isn't in that table.
+    """
+
+    index = {}
+    for priority, flair in enumerate(FLAIRS):
+        for token in FLAIRS[flair]:
+            entry = index.setdefault(token, [None, None, False])
+            entry[0] = priority if entry[0] is None else min(entry[0], priority)
+    for priority, offense_type in enumerate(OFFENSES):
+        for token in OFFENSES[offense_type]:
+            entry = index.setdefault(token, [None, None, False])
+            entry[1] = priority if entry[1] is None else min(entry[1], priority)
+    for token in BLATANT:
+        index.setdefault(token, [None, None, False])[2] = True
+    return index
+
+
+KEYWORDS = build_keyword_index()
+FLAIR_NAMES = list(FLAIRS)
+OFFENSE_NAMES = list(OFFENSES)
+# Match on all words; if the title was something like
+# "[osu!std] rttyu-i | Account Sharing/Multi [ Discussion ]" it would
+# check "account", "sharing", "multi", "[", "discussion", "]"
+TOKEN = re.compile(r"[^|\s/]+")
+
+
+def classify_title(title, offense_start, offense_end):
+    """
+    Determines the offense and flair of the given title in a single pass over its words.
+
+    The flair is matched against the whole title, the offense and blatant? only against title[offense_start:offense_end].
+    If several flairs (or offenses) match, the one listed first in FLAIRS (or OFFENSES) wins.
+    Returns [[offense_name, blatant?], [flair_name, css_class]], see parse_offense_data and parse_flair_data.
+    """
+
+    flair = None
+    offense = None
+    blatant = False
+    for match in TOKEN.finditer(title):
+        entry = KEYWORDS.get(match.group())
+        if entry and entry[0] is not None and (flair is None or entry[0] < flair):
+            flair = entry[0]
+
+        if match.end() <= offense_start or match.start() >= offense_end:
+            continue
+        # a word straddling the start or end of the offense only counts with the part inside it
+        if match.start() < offense_start or match.end() > offense_end:
+            entry = KEYWORDS.get(
+                title[max(match.start(), offense_start) : min(match.end(), offense_end)]
+            )
+        if not entry:
+            continue
+        if entry[1] is not None and (offense is None or entry[1] < offense):
+            offense = entry[1]
+        blatant = blatant or entry[2]
+
+    offense_data = [
+        "other" if offense is None else OFFENSE_NAMES[offense],
+        "true" if blatant else "false",
+    ]
+    if flair is None:
+        flair_data = ["Cheating", "cheating"]
     else:
-        data.append("false")
-    return data
+        flair_data = [FLAIRS[FLAIR_NAMES[flair]][-1], FLAIR_NAMES[flair]]
+    return [offense_data, flair_data]
 
 
 def parse_user_data(username, mode, type):
     """
     Returns a list consisting of the json response the osu api gives us when querying data for the given user in the given mode
+    Found users are cached for USER_CACHE_TTL seconds, so duplicate reports don't hit the api again.
     """
-    user_data = []
+    key = (username, mode, type)
+    data = user_cache.get(key)
+    if data is not None:
+        return data
+
     # temporary hack until peppy fixes old usernames redirecting properly (https://github.com/ppy/osu-api/issues/280)
     # I have no idea why just appending _ instead of _old works, but it does.
     # update 03/12/2023: I think _old -> _ broke at some point, but magnus noticed _old -> ` old`
     # (replace _ with space) works, for whatever reason.
     if username.endswith("_old"):
         username = username.replace("_old", " old")
-    response = requests.get(
-        API_BASE
-        + "get_user?k="
-        + KEY
-        + "&u="
-        + username
-        + "&m="
-        + mode
-        + "&type="
-        + type
-    )
-    user_data = response.json()
+    user_data = osu.get_user(username, mode, type)
 
     if not user_data:  # empty response (user banned / doesn't exist)
         return
 
-    response = requests.get(
-        API_BASE
-        + "get_user_best?k="
-        + KEY
-        + "&u="
-        + username
-        + "&m="
-        + mode
-        + "&type="
-        + type
-    )
-    top_data = response.json()
+    top_data = osu.get_user_best(username, mode, type)
 
-    return [
+    data = [
         user_data[0],
         top_data,
     ]  # we could remove extraneous data here...but honestly it's so low volume anyway
+    user_cache.put(key, data)
+    return data
 
 
-def create_reply(text, data, previous_links, mode):
+def probe_user(user, mode, type):
+    """
+    Checks whether the api knows about the given user, using a single get_user request.
+    Returns USER_EXISTS if the api returned the user, USER_RESTRICTED if the response was empty
+    (user banned / doesn't exist), or USER_ERROR if the request failed or the api returned an error.
+    Probes are background work, so they yield to every other api request.
     """
-    Text is the text of the reddit submission
+    try:
+        user_data = osu.get_user(user, mode, type, priority=LOW)
+    except Exception as e:
+        log.warning("Exception while probing user {}: {}".format(user, str(e)))
+        return USER_ERROR
+
+    # the api responds with {"error": "..."} instead of a list when something went wrong on its end
+    if not isinstance(user_data, list):
+        log.warning("Api error while probing user {}: {}".format(user, user_data))
+        return USER_ERROR
+
+    return USER_EXISTS if user_data else USER_RESTRICTED
+
+
+def create_reply(data, previous_links, mode, DB):
+    """
+    DB is the database interface to cache beatmap data in
     Data is a list of lists - element one is user data, the second element is a list of top plays info json
     Returns a reddit reply-ready string, containing the user's profile, a table with relevant stats of that user,
     and a table with that user's top plays
     """
 
-    sim = None
-    cheated_match = re.search(
-        r"\(cheated\): https:\/\/osu\.ppy\.sh\/scores\/osu\/(\d+)(\/download)?", text
-    )
-    original_match = re.search(
-        r"\(original\): https:\/\/osu\.ppy\.sh\/scores\/osu\/(\d+)(\/download)?", text
-    )
+    user_data = data[0]
+    # user exists, but hasn't made any plays (ie no pp at all)
+    if user_data["pp_raw"] is None:
+        return render_reply(user_data, [], previous_links, mode)
+
+    plays = data[1][0:LIMIT_TOP_PLAYS]
+    # the lookups for each play are independent, so issue them all at once and wait for the slowest.
+    # Uncached beatmaps are also cached from the pool's threads, which commit on their own connections, so the
+    # cache never holds the db's write lock on this thread while the rest of the report is still being handled
+    cached_maps = {
+        play["beatmap_id"]: cached_map_data(play["beatmap_id"], DB) for play in plays
+    }
+    map_futures = {
+        map_id: reply_executor.submit(fetch_map_data, map_id, DB)
+        for map_id, map_data in cached_maps.items()
+        if map_data is None
+    }
+    score_futures = [
+        reply_executor.submit(
+            osu.get_scores,
+            play["beatmap_id"],
+            user_data["user_id"],
+            mode,
+            play["enabled_mods"],
+        )
+        for play in plays
+    ]
+    for map_id, future in map_futures.items():
+        cached_maps[map_id] = future.result()
 
-    if cheated_match and original_match:
-        cheated_id = int(cheated_match.group(1))
-        original_id = int(original_match.group(1))
+    plays = [
+        (play, score_future.result()[0], cached_maps[play["beatmap_id"]])
+        for play, score_future in zip(plays, score_futures)
+    ]
+    return render_reply(user_data, plays, previous_links, mode)
 
-        cheated = ReplayID(cheated_id)
-        original = ReplayID(original_id)
-        sim = cg.similarity(cheated, original)
+
+def render_reply(user_data, plays, previous_links, mode):
+    """
+    Returns the reply for the given user (from get_user) without making any api requests.
+    Plays is a list of (play, score, map) for each top play to list, where play is from get_user_best,
+    score from get_scores, and map from get_beatmaps.
+    """
 
     modes = [
         "osu",
@@ -177,8 +287,6 @@ def create_reply(text, data, previous_links, mode):
         "fruits",
         "mania",
     ]  # can't use ?m=0 to specify a gamepage in userpage url unfortunately
-    user_data = data[0]
-    top_data = data[1]
 
     # user exists, but hasn't made any plays (ie no pp at all)
     if user_data["pp_raw"] is None:
@@ -212,26 +320,13 @@ def create_reply(text, data, previous_links, mode):
         )
     )
 
-    for play in top_data[0:LIMIT_TOP_PLAYS]:
-
-        play_data = requests.get(
-            API_BASE
-            + "get_scores?k="
-            + KEY
-            + "&b="
-            + play["beatmap_id"]
-            + "&u="
-            + user_data["user_id"]
-            + "&m="
-            + mode
-            + "&mods="
-            + play["enabled_mods"]
-        ).json()[0]
+    for play, play_data, map_data in plays:
+
         score_id = play_data["score_id"]
         replay_available = bool(int(play_data["replay_available"]))
 
         reply += "| [{}]({}) | {} | {:,} | {}% ({}) | {} | {} |\n".format(
-            parse_map_data(play["beatmap_id"])["title"],
+            map_data["title"],
             "https://osu.ppy.sh/b/{}".format(play["beatmap_id"]),
             calc_mods(play["enabled_mods"]),
             round(float(play["pp"])),
@@ -253,16 +348,170 @@ def create_reply(text, data, previous_links, mode):
         )
     reply += "\n\n" + previous_links
 
-    # sim can be 0 which is falsey, so direct comparison to None
-    if sim != None:
-        reply += (
-            f"\n\nSimilarity of replays [{cheated_id}](https://osu.ppy.sh/scores/osu/{cheated_id}) "
-            f"and [{original_id}](https://osu.ppy.sh/scores/osu/{original_id}): {round(sim, 2)}"
+    return reply
+
+
+def parse_replay_ids(text):
+    """
+    Returns the score ids of the (cheated) and (original) replays linked in the given submission text,
+    as a tuple (cheated_id, original_id), or None if the text doesn't link both.
+    """
+    cheated_match = re.search(
+        r"\(cheated\): https:\/\/osu\.ppy\.sh\/scores\/osu\/(\d+)(\/download)?", text
+    )
+    original_match = re.search(
+        r"\(original\): https:\/\/osu\.ppy\.sh\/scores\/osu\/(\d+)(\/download)?", text
+    )
+
+    if not (cheated_match and original_match):
+        return None
+    return (int(cheated_match.group(1)), int(original_match.group(1)))
+
+
+def submit_similarity(cheated_id, original_id):
+    """
+    Starts calculating the similarity of the given replays in a similarity worker process.
+    Returns a Future which resolves to the similarity, or raises TimeoutError if it took longer than
+    SIMILARITY_DEADLINE seconds.
+
+    If a worker died (and took the pool down with it), the workers are restarted first.
+    """
+    executor = start_similarity_workers()
+    try:
+        return executor.submit(calc_similarity, cheated_id, original_id)
+    except BrokenProcessPool:
+        log.warning("Similarity workers died, restarting them")
+        restart_similarity_workers(executor)
+        return start_similarity_workers().submit(
+            calc_similarity, cheated_id, original_id
         )
 
-    return reply
+
+def start_similarity_workers(wait=False):
+    """
+    Starts the similarity worker processes if they aren't running yet.
+    If wait is True, blocks until a worker is ready to calculate similarities. Returns the pool.
+
+    Workers are forked from this process, so call this before starting any other threads if possible.
+    """
+    global similarity_executor
+    with similarity_lock:
+        if similarity_executor is None:
+            similarity_executor = ProcessPoolExecutor(
+                max_workers=SIMILARITY_WORKERS, initializer=init_similarity_worker
+            )
+            # the pool only forks its workers on the first submit. Workers take a while to
+            # import circleguard, so only wait on that if asked to
+            started = similarity_executor.submit(int)
+            if wait:
+                started.result()
+        return similarity_executor
+
+
+def restart_similarity_workers(broken):
+    """
+    Throws away the given broken pool, so the next start_similarity_workers starts a new one.
+    Does nothing if another thread already replaced it.
+    """
+    global similarity_executor
+    with similarity_lock:
+        if similarity_executor is broken:
+            similarity_executor = None
+    broken.shutdown(wait=False)
+
+
+def init_similarity_worker():
+    """
+    Runs once in every similarity worker process.
+    """
+    from circleguard import Circleguard
+
+    global cg, replay_cache
+    cg = Circleguard(KEY)
+    signal.signal(signal.SIGALRM, similarity_deadline_passed)
+    replay_cache = ReplayCache(REPLAY_CACHE_PATH, REPLAY_CACHE_SIZE)
+
+
+def calc_similarity(cheated_id, original_id):
+    """
+    Returns the similarity of the given replays. Runs in a similarity worker process.
+    The same replays tend to get linked again in follow up reports, so they're loaded through the replay cache.
+
+    A hung download would otherwise keep the worker (and the reply edit waiting on it) busy forever,
+    so the job is interrupted after SIMILARITY_DEADLINE seconds, and raises TimeoutError instead.
+    """
+    signal.alarm(SIMILARITY_DEADLINE)
+    try:
+        try:
+            cheated = replay_cache.load(cg, cheated_id)
+            original = replay_cache.load(cg, original_id)
+            return cg.similarity(cheated, original)
+        finally:
+            signal.alarm(0)
+    except SimilarityDeadline:
+        raise TimeoutError(
+            "similarity took longer than {} seconds".format(SIMILARITY_DEADLINE)
+        ) from None
+
+
+class SimilarityDeadline(BaseException):
+    """
+    Raised in a similarity worker when its job passes SIMILARITY_DEADLINE, see calc_similarity.
+
+    Not an Exception (unlike TimeoutError, which is also socket.timeout), so the replay cache and the http
+    libraries below it can't mistake it for a failure they know how to handle and carry on without a deadline.
+    """
 
 
-def parse_map_data(map_id):
-    response = requests.get(API_BASE + "get_beatmaps?k=" + KEY + "&b=" + map_id)
-    return response.json()[0]
+def similarity_deadline_passed(signum, frame):
+    raise SimilarityDeadline()
+
+
+def format_similarity(cheated_id, original_id, sim):
+    """
+    Returns the line appended to a reply with the similarity of the given replays.
+    """
+    return (
+        f"\n\nSimilarity of replays [{cheated_id}](https://osu.ppy.sh/scores/osu/{cheated_id}) "
+        f"and [{original_id}](https://osu.ppy.sh/scores/osu/{original_id}): {round(sim, 2)}"
+    )
+
+
+def parse_map_data(map_id, DB):
+    """
+    Returns the api's data for the given beatmap.
+    Data for ranked and approved maps never changes, so it's cached in memory and in the BEATMAPS table of the given db.
+    """
+    map_data = cached_map_data(map_id, DB)
+    if map_data is not None:
+        return map_data
+    return fetch_map_data(map_id, DB)
+
+
+def fetch_map_data(map_id, DB):
+    """
+    Returns the api's data for the given beatmap, skipping the cache (but caching it if it can be).
+    """
+    return cache_map_data(map_id, osu.get_beatmaps(map_id)[0], DB)
+
+
+def cached_map_data(map_id, DB):
+    """
+    Returns the cached data for the given beatmap, or None if it isn't cached.
+    """
+    map_data = beatmap_cache.get(map_id)
+    if map_data is None:
+        map_data = DB.get_beatmap(map_id)
+        if map_data is not None:
+            beatmap_cache.put(map_id, map_data)
+    return map_data
+
+
+def cache_map_data(map_id, map_data, DB):
+    """
+    Caches the given api data for the given beatmap if the map is ranked or approved. Returns map_data.
+    """
+    if map_data["approved"] in BEATMAP_IMMUTABLE:
+        DB.add_beatmap(map_id, map_data)
+        beatmap_cache.put(map_id, map_data)
+    return map_data
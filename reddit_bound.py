@@ -1,6 +1,9 @@
 class RedditBound:
     """
     Interface for objects that are tied to a specific reddit submission.
+
+    title, text and long_link are read from the submission on first access, so a lazy submission
+    (from reddit.submission(id=...)) is only fetched if one of them is actually needed.
     """
 
     def __init__(self, submission, shouldComment, shouldFlair):
@@ -13,11 +16,20 @@ class RedditBound:
         """
 
         self.submission = submission
-        self.title = submission.title.lower()
         self.post_id = submission.id
         self.short_link = "https://redd.it/" + self.post_id
-        self.long_link = submission.permalink
-        self.text = submission.selftext
 
         self.shouldComment = shouldComment
         self.shouldFlair = shouldFlair
+
+    @property
+    def title(self):
+        return self.submission.title.lower()
+
+    @property
+    def long_link(self):
+        return self.submission.permalink
+
+    @property
+    def text(self):
+        return self.submission.selftext
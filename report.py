@@ -2,8 +2,19 @@ from config import SUB, REPLY_IGNORE
 import logging
 from recorder import Recorder
 from reddit_bound import RedditBound
-from config import REPLY_FOOTER
-from parser import parse_title_data, parse_user_data, create_reply
+import time
+from config import REPLY_FOOTER, SIMILARITY_TIMEOUT
+import functools
+import concurrent.futures
+from metrics import timed
+from parser import (
+    parse_title_data,
+    parse_user_data,
+    create_reply,
+    parse_replay_ids,
+    submit_similarity,
+    format_similarity,
+)
 
 
 class Report(Recorder, RedditBound):
@@ -17,6 +28,8 @@ class Report(Recorder, RedditBound):
         Boolean shouldComment: Whether comments should be left on the submission.
         Boolean shouldFlair: Whether the flair of the submission should be modified.
         DB DB: The database interface and connection for this class.
+        List history: The reported user's reports, see get_history.
+        List writes: The db writes waiting for record, as (stage, function) pairs.
     """
 
     log = logging.getLogger()
@@ -37,6 +50,10 @@ class Report(Recorder, RedditBound):
         Recorder.__init__(self, DB)
         RedditBound.__init__(self, submission, shouldComment, shouldFlair)
 
+        self.comment = None  # our reply, once we've left it
+        self.history = None
+        self.writes = []
+        self.read = False
         self.title_data = parse_title_data(self.title)
 
         if self.title_data is not None:
@@ -44,7 +61,8 @@ class Report(Recorder, RedditBound):
             self.username = self.title_data[1]
             self.offense_data = self.title_data[2]
             self.flair_data = self.title_data[3]
-            self.user_data = parse_user_data(self.username, self.gamemode, "string")
+            with timed("user_lookup"):
+                self.user_data = parse_user_data(self.username, self.gamemode, "string")
 
             if self.user_data is not None:
                 self.user_id = self.user_data[0]["user_id"]
@@ -66,8 +84,9 @@ class Report(Recorder, RedditBound):
             return self
 
         Report.log.info("Replying to submission {}".format(self.submission.id))
-        comment = self.submission.reply(message + REPLY_FOOTER)
-        comment.mod.distinguish(how="yes", sticky=True)
+        with timed("reply"):
+            self.comment = self.submission.reply(message + REPLY_FOOTER)
+            self.comment.mod.distinguish(how="yes", sticky=True)
         return self
 
     def reply_data_and_mark(self):
@@ -76,26 +95,59 @@ class Report(Recorder, RedditBound):
         Also adds the user to the users table to be checked for restriction.
 
         Also flairs the post by number of previous reports and id. Should render #flair useless (it'll get overwritten).
+
+        If the report links a cheated and original replay, their similarity is added to the reply. If it takes longer
+        than SIMILARITY_TIMEOUT seconds, the reply is left without it and edited once the similarity is known.
         """
-        self.reply(
-            create_reply(
-                self.text,
+        # start on the similarity first so it runs while we build the rest of the reply
+        replay_ids = parse_replay_ids(self.text)
+        similarity = None
+        if replay_ids:
+            try:
+                similarity = submit_similarity(*replay_ids)
+            except Exception as e:
+                Report.log.warning(
+                    "Exception while starting similarity for post {}: {}".format(
+                        self.post_id, str(e)
+                    )
+                )
+
+        with timed("create_reply"):
+            reply = create_reply(
                 self.user_data,
                 getattr(self, "previous_links", ""),
                 self.gamemode,
+                self.DB,
+            )
+
+        if similarity:
+            try:
+                with timed("similarity_wait"):
+                    sim = similarity.result(timeout=SIMILARITY_TIMEOUT)
+                reply += format_similarity(*replay_ids, sim)
+                similarity = None
+            except concurrent.futures.TimeoutError:
+                Report.log.info(
+                    "Similarity for post {} is taking a while, adding it later".format(
+                        self.post_id
+                    )
+                )
+            except Exception as e:
+                Report.log.warning(
+                    "Exception while calculating similarity for post {}: {}".format(
+                        self.post_id, str(e)
+                    )
+                )
+                similarity = None
+
+        self.reply(reply)
+        if similarity:
+            similarity.add_done_callback(
+                functools.partial(self.add_similarity, reply, replay_ids)
             )
-        )
-        self.DB.add_user(
-            self.post_id,
-            self.user_id,
-            self.submission.created_utc,
-            self.offense_data[0],
-            self.offense_data[1],
-            self.submission.author.name,
-        )
 
-        # I think this is guaranteed to be at least 1 because we add_user'd right before
-        num_previous_reports = len(self.DB.submissions_from_user(self.user_id)) - 1
+        # this report isn't in the db yet, see below
+        num_previous_reports = len(self.get_history())
         rank = int(self.user_data[0]["pp_rank"])
         rank_str = None
         # users with 0 plays have a rank of zero in the api, we don't want to
@@ -119,10 +171,56 @@ class Report(Recorder, RedditBound):
             + "-"
             + (str(num_previous_reports) if num_previous_reports <= 4 else "4-plus")
         )
-        self.submission.mod.flair(flair, flair)
+        with timed("flair"):
+            self.submission.mod.flair(flair, flair)
+
+        # written to the db only once we're done talking to reddit, see record
+        self.writes.append(
+            (
+                "add_user",
+                functools.partial(
+                    self.DB.add_user,
+                    self.post_id,
+                    self.user_id,
+                    self.submission.created_utc,
+                    self.offense_data[0],
+                    self.offense_data[1],
+                    self.submission.author.name,
+                ),
+            )
+        )
 
         return self
 
+    def add_similarity(self, reply, replay_ids, similarity):
+        """
+        Edits our reply to include the similarity of the linked replays.
+        Called with the finished similarity Future once it resolves.
+
+        Args:
+            String reply: The message we replied with (excluding REPLY_FOOTER).
+            Tuple replay_ids: The (cheated_id, original_id) the similarity was calculated for.
+            Future similarity: The finished similarity calculation.
+        """
+
+        if self.comment is None:
+            return
+
+        try:
+            sim = similarity.result()
+            Report.log.info(
+                "Adding similarity to reply on post {}".format(self.post_id)
+            )
+            self.comment.edit(
+                reply + format_similarity(*replay_ids, sim) + REPLY_FOOTER
+            )
+        except Exception as e:
+            Report.log.warning(
+                "Exception while adding similarity to post {}: {}".format(
+                    self.post_id, str(e)
+                )
+            )
+
     def flair(self):
         if self.submission.link_flair_text == "Resolved":
             return self
@@ -135,14 +233,29 @@ class Report(Recorder, RedditBound):
             )
             return self
 
-        self.submission.mod.flair(self.flair_data[0], self.flair_data[1])
+        with timed("flair"):
+            self.submission.mod.flair(self.flair_data[0], self.flair_data[1])
         return self
 
     def has_blacklisted_words(self):
         return [i for i in REPLY_IGNORE if i in self.title]
 
+    def get_history(self):
+        """
+        Returns the reports on the reported user as (post_id, reported_utc, deleted), oldest first.
+        See db#user_history for specific implementation.
+
+        Only queried once per report, so the duplicate check, previous links and flair all share it.
+        This report is only added to the db once they're done with it, see record.
+        """
+
+        if self.history is None:
+            with timed("user_history"):
+                self.history = self.DB.user_history(self.user_id)
+        return self.history
+
     def generate_previous_links(self):
-        reports = self.DB.submissions_from_user(self.user_id)
+        reports = self.get_history()
         if not reports:
             return
         links = ""
@@ -154,16 +267,67 @@ class Report(Recorder, RedditBound):
         return links
 
     def reject(self, reason, remove=False):
-        Report.log.info("Rejecting post {} for {}".format(self.post_id, reason))
-        self.DB.reject_submission(self.post_id, reason)
+        """
+        Removes the submission from the subreddit if remove is True, then marks it read and rejected in the db.
+        """
+
         if remove:
             Report.log.info("Removing post {}".format(self.post_id))
-            self.submission.mod.remove()
+            with timed("remove"):
+                self.submission.mod.remove()
+        Report.log.info("Rejecting post {} for {}".format(self.post_id, reason))
+        self.mark_read()
+        self.writes.append(
+            (
+                "reject",
+                functools.partial(self.DB.reject_submission, self.post_id, reason),
+            )
+        )
         return self
 
     def mark_read(self):
+        """
+        Marks the submission as processed in the db (on record), so it's never processed again.
+        """
+
+        if self.read:
+            return self
         self.log.debug("marking report as read")
-        self.DB.add_submission(self.post_id)
+        self.read = True
+        self.writes.append(
+            ("mark_read", functools.partial(self.DB.add_submission, self.post_id))
+        )
+        return self
+
+    def record(self):
+        """
+        Makes the db writes queued by mark_read, reject and reply_data_and_mark, in a single transaction.
+
+        Called once we're done talking to reddit, so the transaction (which holds the db's write lock from its first
+        write until it commits) never waits on the network.
+
+        If the transaction fails after our reply went up, the submission is still marked read on its own, so it's
+        never replied to twice.
+        """
+
+        writes, self.writes = self.writes, []
+        if not writes:
+            return self
+        try:
+            with self.DB.transaction():
+                for stage, write in writes:
+                    with timed(stage):
+                        write()
+        except Exception:
+            if self.comment is not None and self.read:
+                Report.log.warning(
+                    "Couldn't record post {}, marking it read on its own".format(
+                        self.post_id
+                    )
+                )
+                with timed("mark_read"):
+                    self.DB.add_submission(self.post_id)
+            raise
         return self
 
     def check_malformatted(self):
@@ -173,4 +337,13 @@ class Report(Recorder, RedditBound):
         return self.user_data is None
 
     def check_duplicate(self):
-        return self.DB.user_exists(self.user_id)
+        """
+        Returns the post_id of the first report on the user in the past LIMIT_DAYS days that its author didn't
+        delete, or None if there isn't one.
+        """
+
+        threshold = time.time() - self.DB.LIMIT_SECONDS
+        for post_id, reported_utc, deleted in self.get_history():
+            if reported_utc > threshold and not deleted:
+                return post_id
+        return None
@@ -1,4 +1,5 @@
 from recorder import Recorder
+from utils import next_check
 import logging
 
 
@@ -21,10 +22,61 @@ class Sheriff(Recorder):
 
     def get_records(self):
         """
-        Returns recently reported users (as defined by db#get_recent_users).
+        Returns reported users due for a restriction check (as defined by db#get_due_users).
         """
 
-        return self.DB.get_recent_users()
+        return self.DB.get_due_users()
 
-    def get_recentish_records(self):
-        return self.DB.get_recentish_users()
+    def group_records(self, records):
+        """
+        Groups the given records (as returned by db#get_due_users) by the user they reported.
+
+        Returns a dict of {user_id: [record, ...]}, in the order each user first appears in records.
+        """
+
+        users = {}
+        for record in records:
+            users.setdefault(record[1], []).append(record)
+        return users
+
+    def reschedule(self, records, reports, now):
+        """
+        Schedules the next restriction check of each of the given records (see utils#next_check).
+
+        Args:
+            List records: The records to reschedule, as returned by db#get_due_users.
+            Integer reports: How many times the user the records reported has been reported in total.
+            Float now: The unix timestamp the sweep started at. Sweeps start every CHECK_INTERVAL minutes, so
+                       scheduling from the start (not from whenever the probe finished) keeps a check due
+                       CHECK_INTERVAL minutes later from just missing the next sweep.
+        """
+
+        with self.DB.transaction():
+            for record in records:
+                self.DB.reschedule_user(
+                    record[0], next_check(record[2], record[5], reports, now)
+                )
+
+    def refresh_deleted(self, reddit):
+        """
+        Marks the submissions the duplicate check could still link to (see db#get_linkable_submissions) as deleted
+        if their author deleted them since the last sweep, so processing a report never has to fetch them.
+
+        Args:
+            Reddit reddit: The reddit instance to look the submissions up with.
+
+        Returns:
+            The post_ids of the newly deleted submissions.
+        """
+
+        post_ids = self.DB.get_linkable_submissions()
+        # info looks up 100 submissions per request
+        deleted = [
+            submission.id
+            for submission in reddit.info(["t3_" + post_id for post_id in post_ids])
+            if submission.selftext == "[deleted]"
+        ]
+        with self.DB.transaction():
+            for post_id in deleted:
+                self.DB.mark_deleted(post_id)
+        return deleted
@@ -1,6 +1,6 @@
-import sqlite3
-from config import DB_PATH
-from datetime import datetime
+import sys
+from db import DB, connections, SchemaOutdated
+from datetime import datetime, timezone
 from dateutil import relativedelta
 import random as rand
 
@@ -14,58 +14,54 @@ intros = [
 ]
 
 
-def main():
+def rate(part, whole):
     """
-    Creates a statistics report from the db.db database
+    Returns part as a percentage of whole, or 0 if whole is 0
     """
 
-    c = sqlite3.connect(DB_PATH)
-    current_date = datetime.today()
-    past_date = current_date - relativedelta.relativedelta(months=1)
-    current_date = current_date.strftime("%m/%d/%Y")
-    past_date = past_date.strftime("%m/%d/%Y")
+    return part / whole * 100 if whole else 0
+
+
+def main(since=None, until=None):
+    """
+    Creates a statistics report from the daily statistics in the database (see db#get_stats), covering reports made
+    from since to until (inclusive). until defaults to today, since to a month before until.
 
-    stats = (
-        []
-    )  # [total reports, blatant reports, normal reports, total restrictions, blatant restrictions, normal restrictions]
-    users = (
-        {}
-    )  # {"user": [total reports, blatant reports, reported users that got restricted], ...}
-    query = (
-        "SELECT COUNT(*) AS reports, "
-        "SUM(CASE WHEN BLATANT = 'true' THEN 1 ELSE 0 END) AS blatant, "
-        "SUM(CASE WHEN BLATANT = 'false' THEN 1 ELSE 0 END) AS normal, "
-        "SUM(CASE WHEN RESTRICTED_UTC <> 'n/a' THEN 1 ELSE 0 END) AS restrictions, "
-        "SUM(CASE WHEN BLATANT = 'true' AND RESTRICTED_UTC <> 'n/a' THEN 1 ELSE 0 END) AS 'blatantRestrictions', "
-        "SUM(CASE WHEN BLATANT = 'false' AND RESTRICTED_UTC <> 'n/a' THEN 1 ELSE 0 END) AS 'normalRestrictions' "
-        "FROM USERS"
-    )
-    for row in c.execute(query):
-        stats = [row[0], row[1], row[2], row[3], row[4], row[5]]
+    Args:
+        Date since: The first day (utc) to cover
+        Date until: The last day (utc) to cover
+    """
 
-    query = (
-        "SELECT REPORTEE, "
-        "COUNT(*) as num, "
-        "SUM(CASE WHEN BLATANT = 'true' THEN 1 ELSE 0 END) AS blatantCount, "
-        "SUM(CASE WHEN RESTRICTED_UTC <> 'n/a' THEN 1 ELSE 0 END) AS restrictedCount "
-        "FROM USERS "
-        "GROUP BY REPORTEE "
-        "ORDER BY num DESC "
-        "LIMIT 20"
-    )
-    for row in c.execute(query):
-        users[row[0]] = [row[1], row[2], row[3]]
+    # a report on the db shouldn't change it, schema included
+    connections.read_only = True
+    db = DB(True)
+    current_date = until or datetime.now(timezone.utc).date()
+    past_date = since or current_date - relativedelta.relativedelta(months=1)
 
-    query = (
-        "SELECT AVG(DIFFERENCE) AS AVG FROM ( "
-        "SELECT "
-        "(RESTRICTED_UTC - REPORTED_UTC) AS DIFFERENCE "
-        "FROM USERS "
-        "WHERE RESTRICTED_UTC <> 'n/a')"
-    )
+    try:
+        reports, blatant, restrictions, blatant_restrictions, restriction_seconds = (
+            db.get_stats(past_date.isoformat(), current_date.isoformat())
+        )
+    except SchemaOutdated as e:
+        sys.exit(str(e))
+    stats = [
+        reports,
+        blatant,
+        reports - blatant,
+        restrictions,
+        blatant_restrictions,
+        restrictions - blatant_restrictions,
+    ]  # [total reports, blatant reports, normal reports, total restrictions, blatant restrictions, normal restrictions]
+    users = {
+        row[0]: [row[1], row[2], row[3]]
+        for row in db.get_top_reportees(
+            past_date.isoformat(), current_date.isoformat(), 20
+        )
+    }  # {"user": [total reports, blatant reports, reported users that got restricted], ...}
 
-    average_restriction_seconds = c.execute(query).fetchone()[0]
-    hours = average_restriction_seconds / 60 / 60
+    hours = restriction_seconds / restrictions / 60 / 60 if restrictions else 0
+    current_date = current_date.strftime("%m/%d/%Y")
+    past_date = past_date.strftime("%m/%d/%Y")
 
     body = (
         "{} {} to {}.\n\n"
@@ -92,13 +88,13 @@ def main():
         current_date,
         int(stats[0]),
         int(stats[3]),
-        int(stats[3]) / int(stats[0]) * 100,  # all
+        rate(int(stats[3]), int(stats[0])),  # all
         int(stats[2]),
         int(stats[5]),
-        int(stats[5]) / int(stats[2]) * 100,  # normal
+        rate(int(stats[5]), int(stats[2])),  # normal
         int(stats[1]),
         int(stats[4]),
-        int(stats[4]) / int(stats[1]) * 100,
+        rate(int(stats[4]), int(stats[1])),
     )  # blatant
 
     for user in users:
@@ -108,7 +104,7 @@ def main():
             int(data[0]),
             int(data[1]),
             int(data[2]),
-            int(data[2]) / int(data[0]) * 100,
+            rate(int(data[2]), int(data[0])),
         )
 
     body += (
@@ -2,10 +2,43 @@ import unittest
 import db
 import parser
 import utils
+import cache
+import osu_api
+import metrics
+import intake
+import report
+import sheriff
+import config
+import types
 import sys
+import time
+import os
+import tempfile
+import sqlite3
+import threading
 
 
 class TestMethods(unittest.TestCase):
+    def temp_db(self, setup=None, leadless=False):
+        """
+        Points every DB at a new database for the rest of the test, and returns a DB writing to it.
+        setup is called with a connection to the database before the DB first connects (and migrates it).
+        """
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "db.db")
+        if setup:
+            conn = sqlite3.connect(path)
+            setup(conn)
+            conn.commit()
+            conn.close()
+        connections = db.connections
+        db.connections = db.ConnectionManager(path)
+        db.connections.leadless = leadless
+        self.addCleanup(setattr, db, "connections", connections)
+        return db.DB(leadless)
+
     def test_calcuate_accuracy_from_play(self):
         play = {
             "count50": "0",
@@ -32,6 +65,16 @@ class TestMethods(unittest.TestCase):
         self.assertEqual(utils.calc_mods(4114), "+EZHRSO")
         self.assertEqual(utils.calc_mods(41), "+HDNFSD")
 
+    def test_schedule_next_restriction_check(self):
+        day = 24 * 60 * 60
+        now = 1000 * day
+        self.assertEqual(utils.next_check(now, "false", 1, now), now + 15 * 60)
+        self.assertEqual(
+            utils.next_check(now - 2 * day, "false", 1, now), now + 60 * 60
+        )
+        self.assertEqual(utils.next_check(now - 2 * day, "true", 1, now), now + 30 * 60)
+        self.assertEqual(utils.next_check(now - 365 * day, "true", 5, now), None)
+
     def test_parse_title_data_from_title(self):
         self.assertEqual(
             parser.parse_title_data("[osu!std] tybug2 | blatant multiaccount"),
@@ -63,6 +106,210 @@ class TestMethods(unittest.TestCase):
             parser.parse_title_data("[osu!std] SwordArtOnline_old | cheating"),
             ["0", "SwordArtOnline_old", ["other", "false"], ["Cheating", "cheating"]],
         )
+        # flairs are matched against the whole title, offenses only against the part after the player
+        self.assertEqual(
+            parser.parse_title_data("[osu!std]multi"),
+            ["0", "multi", ["multi", "false"], ["Cheating", "cheating"]],
+        )
+        self.assertEqual(
+            parser.parse_title_data("[osu!std] blatant | discussion multi spin"),
+            ["0", "blatant", ["multi", "false"], ["Discussion", "discussion"]],
+        )
+
+    def test_submission_ids_only_contain_added_ids(self):
+        ids = db.SubmissionIds()
+        ids.update(["fw74zf", "1"])
+        self.assertIn("fw74zf", ids)
+        self.assertIn("1", ids)
+        self.assertNotIn("fw74zg", ids)
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        lru = cache.LRUCache(2)
+        lru.put("a", 1)
+        lru.put("b", 2)
+        self.assertEqual(lru.get("a"), 1)  # "b" is now the least recently used
+        lru.put("c", 3)
+        self.assertEqual(lru.get("b"), None)
+        self.assertEqual(lru.get("a"), 1)
+        self.assertEqual(lru.get("c"), 3)
+
+    def test_ttl_cache_expires_entries(self):
+        ttl = cache.TTLCache(2, ttl=60)
+        ttl.put("a", 1)
+        self.assertEqual(ttl.get("a"), 1)
+        expired = cache.TTLCache(2, ttl=0)
+        expired.put("a", 1)
+        self.assertEqual(expired.get("a"), None)
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = metrics.Histogram("seconds", "help", ["stage"], buckets=[0.1, 1])
+        for value in [0.05, 0.5, 0.5, 5]:
+            histogram.observe(value, stage="reply")
+        self.assertEqual(
+            histogram.render()[2:],
+            [
+                'seconds_bucket{stage="reply",le="0.1"} 1',
+                'seconds_bucket{stage="reply",le="1"} 3',
+                'seconds_bucket{stage="reply",le="+Inf"} 4',
+                'seconds_sum{stage="reply"} 6.05',
+                'seconds_count{stage="reply"} 4',
+            ],
+        )
+
+    def test_intake_shards_by_reported_user(self):
+        workers = intake.Intake(handle=None, workers=8)
+        first = types.SimpleNamespace(id="a", title="[osu!std] tybug2 | relax")
+        second = types.SimpleNamespace(id="b", title="[osu!std] TYBUG2 | multi")
+        self.assertEqual(workers.shard(first), workers.shard(second))
+        spaced = types.SimpleNamespace(id="c", title="[osu!std] some player | relax")
+        underscored = types.SimpleNamespace(
+            id="d", title="[osu!std] some_player | relax"
+        )
+        self.assertEqual(workers.shard(spaced), workers.shard(underscored))
+        self.assertIs(intake.user_lock("2"), intake.user_lock("2"))
+        self.assertTrue(workers.submit(first))
+        self.assertFalse(workers.submit(first))
+        self.assertEqual(sum(depth for depth in workers.depths().values()), 1)
+
+    def test_rate_limiter_waits_once_burst_is_spent(self):
+        limiter = osu_api.RateLimiter(600, burst=2)  # a token every 0.1 seconds
+        start = time.monotonic()
+        limiter.acquire(osu_api.HIGH)
+        limiter.acquire(osu_api.LOW)
+        self.assertLess(time.monotonic() - start, 0.05)
+        limiter.acquire(osu_api.HIGH)
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(limiter.waits[osu_api.HIGH][0], 2)
+
+    def test_duplicate_check_skips_old_and_deleted_reports(self):
+        now = time.time()
+        history = [("old", now - db.DB.LIMIT_SECONDS - 1, 0), ("gone", now, 1)]
+        queries = []
+        _report = report.Report.__new__(report.Report)
+        _report.user_id = "1"
+        _report.history = None
+        _report.DB = types.SimpleNamespace(
+            LIMIT_SECONDS=db.DB.LIMIT_SECONDS,
+            user_history=lambda user_id: queries.append(user_id) or history,
+        )
+        self.assertIsNone(_report.check_duplicate())
+        history.append(("recent", now, 0))
+        self.assertEqual(_report.check_duplicate(), "recent")
+        self.assertEqual(queries, ["1"])
+
+    def test_reschedule_from_sweep_start_is_due_next_sweep(self):
+        database = self.temp_db()
+        # the sweep that probed the report started an interval ago, and the next one is starting now
+        started = time.time() - config.CHECK_INTERVAL * 60
+        database.add_user("p1", "1", started, "relax", "false", "reporter")
+        database.reschedule_user("p1", started)
+        records = database.get_due_users()
+        sheriff.Sheriff(database).reschedule(records, 1, started)
+        self.assertEqual([record[0] for record in database.get_due_users()], ["p1"])
+
+    def test_low_priority_requests_leave_slots_for_high_priority(self):
+        api = osu_api.OsuAPI("key")
+        in_flight = threading.Semaphore(0)
+        release = threading.Event()
+        response = types.SimpleNamespace(
+            status_code=200, raise_for_status=lambda: None, json=lambda: []
+        )
+
+        def get(url, params, timeout):
+            if params.get("u") == "probe":
+                in_flight.release()
+                release.wait(5)
+            return response
+
+        api.session = types.SimpleNamespace(get=get)
+        self.addCleanup(release.set)
+        for _ in range(config.API_MAX_IN_FLIGHT):
+            threading.Thread(
+                target=api.request,
+                args=["get_user"],
+                kwargs={"priority": osu_api.LOW, "u": "probe"},
+                daemon=True,
+            ).start()
+        for _ in range(config.API_LOW_IN_FLIGHT):
+            in_flight.acquire()
+        start = time.monotonic()
+        self.assertEqual(api.request("get_user", u="new report"), [])
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_migrate_original_schema(self):
+        def original(conn):
+            conn.executescript("""
+                CREATE TABLE "SUBMISSIONS" (`ID` VARCHAR ( 8 ) NOT NULL, `REJECTED` BIT(1), `REASON` TEXT,
+                    `RESTRICTED` BIT ( 1 ), PRIMARY KEY(`ID`));
+                CREATE TABLE "USERS" (`POST_ID` VARCHAR ( 10 ) NOT NULL, `USER_ID` VARCHAR ( 10 ) NOT NULL,
+                    `REPORTED_UTC` VARCHAR ( 10 ) NOT NULL, `RESTRICTED_UTC` TEXT, `OFFENSE_TYPE` TEXT NOT NULL,
+                    `BLATANT` BIT ( 1 ) NOT NULL, `REPORTEE` TEXT NOT NULL, PRIMARY KEY(`POST_ID`));
+                INSERT INTO SUBMISSIONS VALUES ('p1', NULL, NULL, 0), ('p2', NULL, NULL, 1);
+                INSERT INTO USERS VALUES ('p1', '1', '1600000000', 'n/a', 'relax', 'false', 'a'),
+                    ('p2', '2', '1600000100.5', '1600000500', 'multi', 'true', 'b');
+                """)
+
+        with self.assertRaises(db.SchemaOutdated):
+            self.temp_db(original, leadless=True).c
+
+        database = self.temp_db(original)
+        c = database.c
+        self.assertEqual(
+            c.execute("PRAGMA user_version").fetchone()[0], len(db.MIGRATIONS)
+        )
+        self.assertEqual(
+            c.execute(
+                "SELECT post_id, typeof(reported_utc), reported_utc, restricted_utc FROM users ORDER BY 1"
+            ).fetchall(),
+            [
+                ("p1", "real", 1600000000.0, None),
+                ("p2", "real", 1600000100.5, 1600000500.0),
+            ],
+        )
+        indexes = {
+            row[0]
+            for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        }
+        for index in [
+            "USERS_USER_ID",
+            "USERS_RESTRICTED",
+            "USERS_NEXT_CHECK",
+            "STATS_REPORTEES_DAY",
+        ]:
+            self.assertIn(index, indexes)
+        self.assertEqual(
+            database.get_stats("2020-09-13", "2020-09-13"), [2, 1, 1, 1, 399.5]
+        )
+        self.assertEqual(
+            c.execute("SELECT id, deleted FROM submissions ORDER BY 1").fetchall(),
+            [("p1", 0), ("p2", 0)],
+        )
+
+    def test_stats_rollups(self):
+        database = self.temp_db()
+        day = 24 * 60 * 60
+        reported = 1600000000  # 2020-09-13 utc
+        database.add_user("p1", "1", reported, "relax", "true", "a")
+        database.add_user("p2", "2", reported + 100, "multi", "false", "a")
+        database.add_user("p3", "3", reported + day, "relax", "false", "b")
+        database.restrict_user("p1", reported + 1000)
+        # restricted again later, only the time to restriction changes
+        database.restrict_user("p1", reported + 1500)
+        database.restrict_user("p3", reported + day + 200)
+
+        self.assertEqual(
+            database.get_stats("2020-09-13", "2020-09-13"), [2, 1, 1, 1, 1500.0]
+        )
+        self.assertEqual(
+            database.get_stats("2020-09-13", "2020-09-14"), [3, 1, 2, 1, 1700.0]
+        )
+        self.assertEqual(
+            database.get_top_reportees("2020-09-13", "2020-09-14", 5),
+            [("a", 2, 1, 1), ("b", 1, 0, 1)],
+        )
+        self.assertEqual(
+            database.get_top_reportees("2020-09-14", "2020-09-14", 5), [("b", 1, 0, 1)]
+        )
 
 
 # def run():
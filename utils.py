@@ -1,4 +1,12 @@
-from config import MODS_INT, MOD_ORDER
+import time
+from config import (
+    MODS_INT,
+    MOD_ORDER,
+    CHECK_INTERVAL,
+    CHECK_SCHEDULE,
+    CHECK_BLATANT_FACTOR,
+    CHECK_REPORTED_FACTOR,
+)
 
 
 def calc_acc(play, mode):
@@ -57,3 +65,29 @@ def calc_mods(mods_int):
 def parse_play_rank(rank):
     ranks = {"X": "SS", "XH": "SS", "SH": "S"}
     return ranks[rank] if rank in ranks else rank
+
+
+def next_check(reported_utc, blatant, reports, now=None):
+    """
+    Returns the unix timestamp a report should next be checked for a restriction at, following CHECK_SCHEDULE,
+    or None if the report is too old to be checked anymore.
+    Blatant reports and reports on users reported several times are checked more often (see CHECK_BLATANT_FACTOR and CHECK_REPORTED_FACTOR).
+
+    Args:
+        Float reported_utc: The unix timestamp the user was reported at
+        String blatant: "true" if the report called the cheats blatant, "false" otherwise
+        Integer reports: How many times the user has been reported in total, including this report
+        Float now: The current unix timestamp, defaults to time.time()
+    """
+    now = time.time() if now is None else now
+    age = now - float(reported_utc)
+    for days, interval in CHECK_SCHEDULE:
+        if age < days * 24 * 60 * 60:
+            break
+    else:
+        return None
+
+    if blatant == "true":
+        interval *= CHECK_BLATANT_FACTOR
+    interval *= CHECK_REPORTED_FACTOR ** min(max(reports - 1, 0), 4)
+    return now + max(interval, CHECK_INTERVAL * 60)